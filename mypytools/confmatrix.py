@@ -4,7 +4,39 @@ Created on Mon Aug 19 12:35:40 2019
 
 @author: r.realrangel
 """
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import inspect
 import numpy as np
+import xarray as xr
+
+
+def _as_float(count):
+    """Cast a count (a scalar, a numpy.ndarray or an xarray object) to
+    float without losing its type."""
+    if hasattr(count, 'astype'):
+        return(count.astype('float64'))
+
+    else:
+        return(np.float64(count))
+
+
+def _divide(numerator, denominator):
+    """Element-wise division that gives NaN where the denominator is
+    zero."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = numerator / denominator
+
+    if hasattr(ratio, 'where'):
+        return(ratio.where(denominator != 0))
+
+    ratio = np.where(denominator != 0, ratio, np.nan)
+
+    if np.ndim(ratio) == 0:
+        return(float(ratio))
+
+    else:
+        return(ratio)
 
 
 # =============================================================================
@@ -23,25 +55,25 @@ def pc(hits, corrneg, n):
 
     Parameters
     ----------
-    hits : float
+    hits : float or array_like
         Occasions in which the event in question was succesfully
         forecast to occur. Also called "hits".
-    corrneg : float
+    corrneg : float or array_like
         Instances of the event not occurring after a forecast that it
         would not occur. Sometimes called "correct rejection" or
         "correct negative".
-    n : flot
+    n : float or array_like
         Number of events.
 
     Return
     ------
-    float
+    float or array_like
         The value of the proportion correct.
     """
-    hits = float(hits)
-    corrneg = float(corrneg)
-    n = float(n)
-    return((hits + corrneg) / n)
+    hits = _as_float(hits)
+    corrneg = _as_float(corrneg)
+    n = _as_float(n)
+    return(_divide((hits + corrneg), n))
 
 
 def ts(hits, falseal, misses):
@@ -59,30 +91,25 @@ def ts(hits, falseal, misses):
 
     Parameters
     ----------
-    hits : float
+    hits : float or array_like
         Occasions in which the event in question was succesfully
         forecast to occur. Also called "hits".
-    falseal : float
+    falseal : float or array_like
         Occasions called "false alarms" on which the event was forcast
         to occur but did not.
-    misses : float
+    misses : float or array_like
         Instances of the event of interest occurring after a forecast
         that it would not occur, called "misses".
 
     Return
     ------
-    float
+    float or array_like
         The value of the threat score.
     """
-    hits = float(hits)
-    falseal = float(falseal)
-    misses = float(misses)
-
-    try:
-        return(hits / (hits + falseal + misses))
-
-    except ZeroDivisionError:
-        return(np.nan)
+    hits = _as_float(hits)
+    falseal = _as_float(falseal)
+    misses = _as_float(misses)
+    return(_divide(hits, (hits + falseal + misses)))
 
 
 # Reliability and resolution.
@@ -101,26 +128,21 @@ def far(hits, falseal):
 
     Parameters
     ----------
-    hits : float
+    hits : float or array_like
         Occasions in which the event in question was succesfully
         forecast to occur. Also called "hits".
-    falseal : float
+    falseal : float or array_like
         Occasions called "false alarms" on which the event was forcast
         to occur but did not.
 
     Return
     ------
-    float
+    float or array_like
         The value of the false alarm ratio.
     """
-    hits = float(hits)
-    falseal = float(falseal)
-
-    try:
-        return(falseal / (hits + falseal))
-
-    except ZeroDivisionError:
-        return(np.nan)
+    hits = _as_float(hits)
+    falseal = _as_float(falseal)
+    return(_divide(falseal, (hits + falseal)))
 
 
 # Discriminiation.
@@ -137,26 +159,21 @@ def h(hits, misses):
 
     Parameters
     ----------
-    hits : float
+    hits : float or array_like
         Occasions in which the event in question was succesfully
         forecast to occur. Also called "hits".
-    misses : float
+    misses : float or array_like
         Instances of the event of interest occurring after a forecast
         that it would not occur, called "misses".
 
     Return
     ------
-    float
+    float or array_like
         The value of the hit rate.
     """
-    hits = float(hits)
-    misses = float(misses)
-
-    try:
-        return(hits / (hits + misses))
-
-    except ZeroDivisionError:
-        return(np.nan)
+    hits = _as_float(hits)
+    misses = _as_float(misses)
+    return(_divide(hits, (hits + misses)))
 
 
 # =============================================================================
@@ -178,34 +195,34 @@ def heidke_ss(hits, falseal, misses, corrneg):
 
     Parameters
     ----------
-    hits : float
+    hits : float or array_like
         Occasions in which the event in question was succesfully
         forecast to occur. Also called "hits".
-    falseal : float
+    falseal : float or array_like
         Occasions called "false alarms" on which the event was forcast
         to occur but did not.
-    misses : float
+    misses : float or array_like
         Instances of the event of interest occurring after a forecast
         that it would not occur, called "misses".
-    corrneg : float
+    corrneg : float or array_like
         Instances of the event not occurring after a forecast that it
         would not occur. Sometimes called "correct rejection" or
         "correct negative".
 
     Return
     ------
-    float
+    float or array_like
         The value of the Heidke Skill Score.
     """
-    hits = float(hits)
-    falseal = float(falseal)
-    misses = float(misses)
-    corrneg = float(corrneg)
-    return(
-        (2 * ((hits * corrneg) - (falseal * misses))) /
+    hits = _as_float(hits)
+    falseal = _as_float(falseal)
+    misses = _as_float(misses)
+    corrneg = _as_float(corrneg)
+    return(_divide(
+        (2 * ((hits * corrneg) - (falseal * misses))),
         (((hits + misses) * (misses + corrneg)) +
          ((hits + falseal) * (falseal + corrneg)))
-        )
+        ))
 
 
 def peirce_ss(hits, falseal, misses, corrneg):
@@ -226,33 +243,33 @@ def peirce_ss(hits, falseal, misses, corrneg):
 
     Parameters
     ----------
-    hits : float
+    hits : float or array_like
         Occasions in which the event in question was succesfully
         forecast to occur. Also called "hits".
-    falseal : float
+    falseal : float or array_like
         Occasions called "false alarms" on which the event was forcast
         to occur but did not.
-    misses : float
+    misses : float or array_like
         Instances of the event of interest occurring after a forecast
         that it would not occur, called "misses".
-    corrneg : float
+    corrneg : float or array_like
         Instances of the event not occurring after a forecast that it
         would not occur. Sometimes called "correct rejection" or
         "correct negative".
 
     Return
     ------
-    float
+    float or array_like
         The value of the Peirce Skill Score.
     """
-    hits = float(hits)
-    falseal = float(falseal)
-    misses = float(misses)
-    corrneg = float(corrneg)
-    return(
-        ((hits * corrneg) - (falseal * misses)) /
+    hits = _as_float(hits)
+    falseal = _as_float(falseal)
+    misses = _as_float(misses)
+    corrneg = _as_float(corrneg)
+    return(_divide(
+        ((hits * corrneg) - (falseal * misses)),
         ((hits + misses) * (falseal + corrneg))
-        )
+        ))
 
 
 def clayton_ss(hits, falseal, misses, corrneg):
@@ -263,33 +280,33 @@ def clayton_ss(hits, falseal, misses, corrneg):
 
     Parameters
     ----------
-    hits : float
+    hits : float or array_like
         Occasions in which the event in question was succesfully
         forecast to occur. Also called "hits".
-    falseal : float
+    falseal : float or array_like
         Occasions called "false alarms" on which the event was forcast
         to occur but did not.
-    misses : float
+    misses : float or array_like
         Instances of the event of interest occurring after a forecast
         that it would not occur, called "misses".
-    corrneg : float
+    corrneg : float or array_like
         Instances of the event not occurring after a forecast that it
         would not occur. Sometimes called "correct rejection" or
         "correct negative".
 
     Return
     ------
-    float
+    float or array_like
         The value of the Peirce Skill Score.
     """
-    hits = float(hits)
-    falseal = float(falseal)
-    misses = float(misses)
-    corrneg = float(corrneg)
-    return(
-        ((hits * corrneg) - (falseal * misses)) /
+    hits = _as_float(hits)
+    falseal = _as_float(falseal)
+    misses = _as_float(misses)
+    corrneg = _as_float(corrneg)
+    return(_divide(
+        ((hits * corrneg) - (falseal * misses)),
         ((hits + falseal) * (misses + corrneg))
-        )
+        ))
 
 
 def gilbert_ss(hits, falseal, misses, corrneg):
@@ -300,29 +317,480 @@ def gilbert_ss(hits, falseal, misses, corrneg):
 
     Parameters
     ----------
-    hits : float
+    hits : float or array_like
         Occasions in which the event in question was succesfully
         forecast to occur. Also called "hits".
-    falseal : float
+    falseal : float or array_like
         Occasions called "false alarms" on which the event was forcast
         to occur but did not.
-    misses : float
+    misses : float or array_like
         Instances of the event of interest occurring after a forecast
         that it would not occur, called "misses".
-    corrneg : float
+    corrneg : float or array_like
         Instances of the event not occurring after a forecast that it
         would not occur. Sometimes called "correct rejection" or
         "correct negative".
 
     Return
     ------
-    float
+    float or array_like
         The value of the Peirce Skill Score.
     """
-    hits = float(hits)
-    falseal = float(falseal)
-    misses = float(misses)
-    corrneg = float(corrneg)
+    hits = _as_float(hits)
+    falseal = _as_float(falseal)
+    misses = _as_float(misses)
+    corrneg = _as_float(corrneg)
     n = hits + falseal + misses + corrneg
-    a_ref = ((hits + falseal) * (hits + misses)) / n
-    return((hits - a_ref) / (hits - a_ref + falseal + misses))
+    a_ref = _divide(((hits + falseal) * (hits + misses)), n)
+    return(_divide((hits - a_ref), (hits - a_ref + falseal + misses)))
+
+
+# =============================================================================
+# Contingency tables
+# =============================================================================
+class ContingencyTable(namedtuple(
+        'ContingencyTable', ['hits', 'falseal', 'misses', 'corrneg']
+        )):
+    """Counts of 2×2 contingency tables (scalars or arrays).
+
+    Any score of this module can be computed from it with the score
+    method, e.g., table.score(heidke_ss).
+    """
+    __slots__ = ()
+
+    @property
+    def n(self):
+        return(self.hits + self.falseal + self.misses + self.corrneg)
+
+    def score(self, function):
+        """Compute a score of this module (e.g., ts or peirce_ss).
+
+        Parameters
+        ----------
+        function : callable
+            The score. Its arguments are taken from the counts by name.
+
+        Return
+        ------
+        float or array_like
+            The value of the score.
+        """
+        counts = dict(self._asdict(), n=self.n)
+        return(function(**{
+            name: counts[name]
+            for name in inspect.signature(function).parameters
+            }))
+
+
+def _contingency_counts(forecast, observed, thresholds, event):
+    """Count the tables of every group (rows) and threshold.
+
+    The position of the first threshold at which each value is an event
+    is found with a binary search, and the (forecast, observed)
+    positions of every group are accumulated in one bincount. The
+    counts of every threshold are then cumulative sums of it.
+
+    Return an int64 array of shape (4, thresholds, groups) with the
+    hits, false alarms, misses and correct negatives.
+    """
+    thresholds = np.asarray(thresholds, dtype='float64')
+    sign = 1 if event == 'below' else -1
+    order = np.argsort(sign * thresholds, kind='mergesort')
+    k = len(thresholds)
+    groups = np.shape(forecast)[0]
+    valid = ~(np.isnan(forecast) | np.isnan(observed))
+    f_pos = np.searchsorted((sign * thresholds)[order], sign * forecast)
+    o_pos = np.searchsorted((sign * thresholds)[order], sign * observed)
+    bins = (
+        (np.arange(groups).reshape(-1, 1) * (k + 1) + f_pos) * (k + 1)
+        ) + o_pos
+    hist = np.bincount(
+        bins[valid],
+        minlength=(groups * ((k + 1) ** 2))
+        ).reshape(groups, k + 1, k + 1)
+    cum = hist.cumsum(axis=1).cumsum(axis=2)
+    j = np.arange(k)
+    hits = cum[:, j, j]
+    fcst_yes = cum[:, j, k]
+    obs_yes = cum[:, k, j]
+    total = cum[:, k, k].reshape(-1, 1)
+    counts = np.stack([
+        hits,
+        fcst_yes - hits,
+        obs_yes - hits,
+        total - fcst_yes - obs_yes + hits
+        ])
+    output = np.empty_like(counts)
+    output[:, :, order] = counts
+    return(np.moveaxis(output, source=2, destination=1))
+
+
+def contingency_table(
+        forecast, observed, thresholds, dim=None, event='below'
+        ):
+    """Build the 2×2 contingency tables of forecast and observed fields.
+
+    The four counts of every threshold are computed in a single pass
+    over the data. Pairs with a missing forecast or observation are
+    not counted.
+
+    Parameters
+    ----------
+    forecast, observed : numpy.ndarray or xarray.DataArray
+        The forecast and observed fields (e.g., time, lat, lon).
+    thresholds : float or sequence of float
+        The thresholds that define the events.
+    dim : int, str or sequence, optional
+        The axes (numpy) or dimensions (xarray) over which the pairs
+        are counted (e.g., 'time'). By default, None (all of them).
+    event : str, optional
+        'below', if the event is a value lower than or equal to the
+        threshold (e.g., a drought index), or 'above', if it is a value
+        greater than or equal to the threshold. By default, 'below'.
+
+    Return
+    ------
+    ContingencyTable
+        The counts. Their shape is (thresholds, other axes), without the
+        first axis if thresholds is a scalar. With xarray inputs they
+        are DataArrays with a 'threshold' dimension.
+    """
+    scalar = np.ndim(thresholds) == 0
+    thresholds = np.atleast_1d(thresholds)
+
+    if isinstance(forecast, xr.DataArray):
+        forecast, observed = xr.broadcast(forecast, observed)
+        reduced = list(forecast.dims) if dim is None else (
+            [dim] if isinstance(dim, str) else list(dim)
+            )
+        kept = [d for d in forecast.dims if d not in reduced]
+        forecast = forecast.transpose(*(kept + reduced))
+        observed = observed.transpose(*(kept + reduced))
+        kept_shape = forecast.shape[:len(kept)]
+        counts = _contingency_counts(
+            forecast=forecast.values.reshape(int(np.prod(kept_shape)), -1),
+            observed=observed.values.reshape(int(np.prod(kept_shape)), -1),
+            thresholds=thresholds,
+            event=event
+            ).reshape((4, len(thresholds)) + kept_shape)
+        coords = {d: forecast[d] for d in kept if d in forecast.coords}
+        coords['threshold'] = thresholds
+        counts = [
+            xr.DataArray(
+                data=count,
+                coords=coords,
+                dims=['threshold'] + kept
+                )
+            for count in counts
+            ]
+
+    else:
+        forecast, observed = np.broadcast_arrays(
+            np.asarray(forecast, dtype='float64'),
+            np.asarray(observed, dtype='float64')
+            )
+        reduced = list(range(forecast.ndim)) if dim is None else [
+            d % forecast.ndim for d in np.atleast_1d(dim)
+            ]
+        kept = [d for d in range(forecast.ndim) if d not in reduced]
+        forecast = np.transpose(forecast, kept + reduced)
+        observed = np.transpose(observed, kept + reduced)
+        kept_shape = forecast.shape[:len(kept)]
+        counts = list(_contingency_counts(
+            forecast=forecast.reshape(int(np.prod(kept_shape)), -1),
+            observed=observed.reshape(int(np.prod(kept_shape)), -1),
+            thresholds=thresholds,
+            event=event
+            ).reshape((4, len(thresholds)) + kept_shape))
+
+    if scalar:
+        counts = [count[0] for count in counts]
+
+    return(ContingencyTable(*counts))
+
+
+class ContingencyAccumulator():
+    """Running contingency tables of forecast/observed fields.
+
+    The tables are updated chunk by chunk (e.g., a year of daily fields
+    at a time), so fields larger than memory can be verified. The
+    counts of accumulators run in different processes can be merged,
+    and any score of this module can be computed at any time.
+
+    Parameters
+    ----------
+    thresholds : float or sequence of float
+        The thresholds that define the events.
+    dim : int, str or sequence, optional
+        The axes or dimensions over which the pairs are counted (see
+        contingency_table). The chunks must be split along them. By
+        default, None (all of them).
+    event : str, optional
+        'below' or 'above' (see contingency_table). By default,
+        'below'.
+    """
+    def __init__(self, thresholds, dim=None, event='below'):
+        self.thresholds = thresholds
+        self.dim = dim
+        self.event = event
+        self.table = None
+
+    def update(self, forecast, observed):
+        """Add the counts of a chunk of forecast and observed fields."""
+        return(self._add(contingency_table(
+            forecast=forecast,
+            observed=observed,
+            thresholds=self.thresholds,
+            dim=self.dim,
+            event=self.event
+            )))
+
+    def consume(self, chunks):
+        """Add the counts of every (forecast, observed) pair of chunks
+        yielded by an iterable (e.g., a generator)."""
+        for forecast, observed in chunks:
+            self.update(forecast=forecast, observed=observed)
+
+        return(self)
+
+    def consume_dataarray(self, forecast, observed, dim='time', size=None):
+        """Add the counts of (dask-backed) DataArrays block by block.
+
+        Parameters
+        ----------
+        forecast, observed : xarray.DataArray
+            The forecast and observed fields.
+        dim : str, optional
+            The dimension along which the blocks are taken. It must be
+            one of the dimensions over which the pairs are counted. By
+            default, 'time'.
+        size : int, optional
+            The length of the blocks. By default, None (the dask chunks
+            of forecast along dim, or a single block if it is not a dask
+            array).
+        """
+        if size is None:
+            sizes = forecast.chunksizes.get(dim, [forecast.sizes[dim]])
+
+        else:
+            sizes = [size] * int(np.ceil(forecast.sizes[dim] / float(size)))
+
+        first = 0
+
+        for length in sizes:
+            block = {dim: slice(first, first + length)}
+            self.update(
+                forecast=forecast.isel(block).load(),
+                observed=observed.isel(block).load()
+                )
+            first += length
+
+        return(self)
+
+    def merge(self, other):
+        """Add the counts of another accumulator (e.g., one run in
+        another process)."""
+        if other.table is not None:
+            self._add(other.table)
+
+        return(self)
+
+    def score(self, function):
+        """Compute a score of this module from the counts so far."""
+        return(self.table.score(function))
+
+    def _add(self, table):
+        if self.table is None:
+            self.table = table
+
+        else:
+            self.table = ContingencyTable(*[
+                total + count
+                for total, count in zip(self.table, table)
+                ])
+
+        return(self)
+
+
+# =============================================================================
+# Bootstrap
+# =============================================================================
+def _resample_indices(n, resamples, block, rng):
+    """Draw a (resamples, n) matrix of (moving block) bootstrap indices."""
+    blocks = int(np.ceil(n / float(block)))
+    starts = rng.integers(0, n - block + 1, size=(resamples, blocks))
+    indices = starts[:, :, np.newaxis] + np.arange(block)
+    return(indices.reshape(resamples, blocks * block)[:, :n])
+
+
+def _resample_counts(counts, resamples, block, seed):
+    """Count the tables of a batch of resamples of the time steps.
+
+    The multiplicity of every time step in every resample is found with
+    one bincount, and the tables of all resamples are its product with
+    the tables of the time steps.
+    """
+    n = counts.shape[0]
+    indices = _resample_indices(
+        n=n,
+        resamples=resamples,
+        block=block,
+        rng=np.random.default_rng(seed)
+        )
+    indices += np.arange(resamples).reshape(-1, 1) * n
+    weights = np.bincount(
+        indices.ravel(),
+        minlength=resamples * n
+        ).reshape(resamples, n)
+    return(np.rint(weights.astype('float64') @ counts).astype('int64'))
+
+
+def bootstrap_table(
+        forecast, observed, thresholds, dim=0, event='below',
+        resamples=1000, block=1, seed=None, workers=None, batch=256
+        ):
+    """Build the contingency tables of bootstrap resamples.
+
+    The time steps (with all the pairs of their fields) are resampled
+    with replacement, in blocks of consecutive steps to keep their
+    autocorrelation (moving block bootstrap). The counts of every
+    resample are computed at once, so any score of this module can be
+    computed for all of them with the score method.
+
+    Parameters
+    ----------
+    forecast, observed : numpy.ndarray or xarray.DataArray
+        The forecast and observed fields (e.g., time, lat, lon).
+    thresholds : float or sequence of float
+        The thresholds that define the events.
+    dim : int or str, optional
+        The axis (numpy) or dimension (xarray) of the time steps. An
+        int also selects the dimension of a DataArray by position. The
+        pairs of the other axes are pooled. By default, 0.
+    event : str, optional
+        'below' or 'above' (see contingency_table). By default,
+        'below'.
+    resamples : int, optional
+        The number of resamples. By default, 1000.
+    block : int, optional
+        The length of the resampled blocks. By default, 1 (ordinary
+        bootstrap).
+    seed : int, optional
+        The seed of the random generator. The resamples do not depend on
+        the number of workers. By default, None.
+    workers : int, optional
+        The number of threads among which the batches of resamples are
+        distributed. By default, None (serial).
+    batch : int, optional
+        The number of resamples drawn at a time. By default, 256.
+
+    Return
+    ------
+    ContingencyTable
+        The counts. Their shape is (resamples, thresholds), without the
+        last axis if thresholds is a scalar.
+    """
+    scalar = np.ndim(thresholds) == 0
+    thresholds = np.atleast_1d(thresholds)
+
+    if isinstance(forecast, xr.DataArray):
+        forecast, observed = xr.broadcast(forecast, observed)
+        dim = forecast.dims[dim] if isinstance(dim, int) else dim
+        forecast = forecast.transpose(dim, ...).values
+        observed = observed.transpose(dim, ...).values
+
+    else:
+        forecast, observed = np.broadcast_arrays(
+            np.asarray(forecast, dtype='float64'),
+            np.asarray(observed, dtype='float64')
+            )
+        forecast = np.moveaxis(forecast, source=dim, destination=0)
+        observed = np.moveaxis(observed, source=dim, destination=0)
+
+    n = forecast.shape[0]
+    counts = _contingency_counts(
+        forecast=forecast.reshape(n, -1),
+        observed=observed.reshape(n, -1),
+        thresholds=thresholds,
+        event=event
+        )
+    counts = counts.transpose(2, 0, 1).reshape(n, -1).astype('float64')
+    sizes = [batch] * (resamples // batch)
+
+    if resamples % batch:
+        sizes.append(resamples % batch)
+
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    block = min(block, n)
+
+    if workers is None:
+        tables = [
+            _resample_counts(
+                counts=counts,
+                resamples=size,
+                block=block,
+                seed=child
+                )
+            for size, child in zip(sizes, seeds)
+            ]
+
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            tables = list(executor.map(
+                lambda args: _resample_counts(counts, *args),
+                [(size, block, child) for size, child in zip(sizes, seeds)]
+                ))
+
+    tables = np.concatenate(tables).reshape(resamples, 4, len(thresholds))
+    counts = list(np.moveaxis(tables, source=1, destination=0))
+
+    if scalar:
+        counts = [count[:, 0] for count in counts]
+
+    return(ContingencyTable(*counts))
+
+
+def bootstrap_interval(
+        function, forecast, observed, thresholds, level=0.95, **kwargs
+        ):
+    """Compute a score and its bootstrap (percentile) confidence interval.
+
+    Parameters
+    ----------
+    function : callable
+        The score (e.g., heidke_ss or peirce_ss).
+    forecast, observed : numpy.ndarray or xarray.DataArray
+        The forecast and observed fields (e.g., time, lat, lon).
+    thresholds : float or sequence of float
+        The thresholds that define the events.
+    level : float, optional
+        The confidence level. By default, 0.95.
+    **kwargs
+        Other arguments of bootstrap_table (e.g., dim, event, resamples,
+        block, seed or workers).
+
+    Return
+    ------
+    tuple
+        The score of the whole sample and the lower and upper limits of
+        the interval (floats, or arrays by threshold).
+    """
+    table = bootstrap_table(
+        forecast=forecast,
+        observed=observed,
+        thresholds=thresholds,
+        **kwargs
+        )
+    score = contingency_table(
+        forecast=forecast,
+        observed=observed,
+        thresholds=thresholds,
+        event=kwargs.get('event', 'below')
+        ).score(function)
+    scores = table.score(function)
+    lower, upper = np.nanpercentile(
+        scores,
+        [50 * (1 - level), 50 * (1 + level)],
+        axis=0
+        )
+    return(np.asarray(score), lower, upper)
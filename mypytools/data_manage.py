@@ -4,24 +4,74 @@ Created on Thu Mar 19 22:13:46 2020
 
 @author: rreal
 """
+import os as _os
+import numpy as _np
 import pandas as _pd
 
 
 class IiSdi():
     """
+    Percentiles of a SDI time series (monthly values, with dates as
+    %Y%m in the first column).
+
+    All the percentile columns of a file are read once and shared by
+    every instance of the same file (the cache is refreshed if the file
+    changes), together with the positions of each month.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the CSV file.
+    percentile : str or list of str
+        Percentile column(s) of Series.
     """
+    # (data, positions of each month) by file.
+    _cache = {}
+
     def __init__(self, filepath, percentile):
         self._filepath = filepath
-        self.Series = _pd.read_csv(
-            filepath_or_buffer=self._filepath,
-            usecols=[0, 3],
-            index_col=0,
-            parse_dates=True,
-            date_parser=lambda x: _pd.to_datetime(
-                arg=x,
-                format='%Y%m'
-                ) + _pd.tseries.offsets.MonthEnd(1)
-            )[percentile]
-
-    def get_monthly_ts(self, month):
-        return(self.Series[self.Series.index.month == month])
+        self.percentile = percentile
+        self.Data, self._months = self._read(filepath)
+        self.Series = self.Data[percentile]
+
+    @classmethod
+    def _read(cls, filepath):
+        status = _os.stat(filepath)
+        key = (
+            _os.path.abspath(filepath),
+            status.st_mtime_ns,
+            status.st_size
+            )
+
+        if key not in cls._cache:
+            data = _pd.read_csv(
+                filepath_or_buffer=filepath,
+                index_col=0
+                )
+            data.index = _pd.DatetimeIndex(
+                _pd.to_datetime(
+                    arg=data.index.astype(str),
+                    format='%Y%m'
+                    ) + _pd.tseries.offsets.MonthEnd(1),
+                name=data.index.name
+                )
+            months = data.index.month.values
+            order = _np.argsort(months, kind='stable')
+            bounds = _np.searchsorted(months[order], _np.arange(1, 14))
+            cls._cache = {
+                cached: value
+                for cached, value in cls._cache.items()
+                if cached[0] != key[0]
+                }
+            cls._cache[key] = (data, {
+                month: order[bounds[month - 1]:bounds[month]]
+                for month in range(1, 13)
+                })
+
+        return(cls._cache[key])
+
+    def get_monthly_ts(self, month, percentile=None):
+        if percentile is None:
+            return(self.Series.iloc[self._months[month]])
+
+        return(self.Data[percentile].iloc[self._months[month]])
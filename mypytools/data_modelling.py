@@ -4,14 +4,178 @@ Created on Tue Mar 10 14:30:22 2020
 
 @author: rreal
 """
+from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
 from sklearn.metrics import mean_squared_error as _mse
 from sklearn.model_selection import KFold as _KFold
-from statsmodels.nonparametric.smoothers_lowess import _lowess
 import numpy as _np
 
 
-def optimal_lowess(x, y, fracs=11, xval_folds=3, random_seeds=range(3)):
+def lowess_fit(x, y, frac, it=2, block=4096, max_memory=2**22):
     """
+    LOWESS (locally weighted linear regression) of sorted data.
+
+    It follows the algorithm of statsmodels' lowess (tricube weights
+    over the k = frac * n nearest neighbors and bisquare robustness
+    weights), but every point is fitted at once: since x is sorted, the
+    neighbors of each point are a contiguous window of x whose first
+    index is found with a single binary search, so each fit costs
+    O(n * k) vectorized operations instead of a loop over the points.
+    The windows and their tricube weights do not change between the
+    robustifying iterations, so they are built once when they fit in
+    max_memory, and each iteration only reweights them.
+
+    References:
+    Cleveland, W. S. (1979). Robust Locally Weighted Regression and
+        Smoothing Scatterplots. Journal of the American Statistical
+        Association, 74(368), 829-836.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        The values of the independent variable, in ascending order.
+    y : numpy.ndarray
+        The values of the dependent variable.
+    frac : float
+        Fraction of the data used to fit each value.
+    it : int, optional
+        Number of robustifying iterations. By default, 2.
+    block : int, optional
+        Maximum number of points fitted at once. By default, 4096.
+    max_memory : int, optional
+        Maximum number of window elements (points times neighbors) held
+        at once. By default, 2**22.
+
+    Returns
+    -------
+    numpy.ndarray
+        The fitted values of y.
+    """
+    x = _np.asarray(x, dtype='float64')
+    y = _np.asarray(y, dtype='float64')
+    n = len(x)
+    k = min(max(int(frac * n + 1e-10), 2), n)
+    block = max(min(block, max_memory // k), 1)
+
+    # First index of the window of the k nearest neighbors of each x.
+    left = _np.minimum(
+        _np.searchsorted((x[:n - k] + x[k:]) / 2.0, x, side='left'),
+        n - k
+        )
+
+    def windows(rows):
+        """Neighbors, distances to the fitted x and tricube weights."""
+        window = left[rows, _np.newaxis] + _np.arange(k)
+        x_val = x[rows, _np.newaxis]
+        x_dev = x[window] - x_val
+        radius = _np.maximum(
+            x_val[:, 0] - x[left[rows]],
+            x[left[rows] + k - 1] - x_val[:, 0]
+            )[:, _np.newaxis]
+
+        with _np.errstate(invalid='ignore', divide='ignore'):
+            weights = 1.0 - (_np.abs(x_dev) / radius) ** 3
+
+        return(window, x_dev, y[window], weights * weights * weights)
+
+    blocks = [slice(first, first + block) for first in range(0, n, block)]
+    cache = [windows(rows) for rows in blocks] if n * k <= max_memory else None
+    resid_weights = _np.ones(n)
+
+    for _iter in range(it + 1):
+        y_fit = _np.empty(n)
+
+        for b, rows in enumerate(blocks):
+            window, x_dev, y_j, weights = (
+                windows(rows) if cache is None else cache[b]
+                )
+            weights = weights * resid_weights[window]
+            weighted_dev = weights * x_dev
+
+            # Weighted means of (x - x_val), its square, y and their
+            # product, with which the local linear fit is evaluated.
+            with _np.errstate(invalid='ignore', divide='ignore'):
+                total = weights.sum(axis=1)
+                mean_dev = weighted_dev.sum(axis=1) / total
+                mean_y = _np.einsum('ij,ij->i', weights, y_j) / total
+                weighted_sqdev_x = _np.maximum(
+                    _np.einsum('ij,ij->i', weighted_dev, x_dev) / total -
+                    (mean_dev * mean_dev),
+                    1e-12
+                    )
+                cov = (
+                    _np.einsum('ij,ij->i', weighted_dev, y_j) / total -
+                    (mean_dev * mean_y)
+                    )
+                y_fit[rows] = _np.where(
+                    (weights > 1e-12).sum(axis=1) >= 2,
+                    mean_y - (mean_dev * cov / weighted_sqdev_x),
+                    y[rows]
+                    )
+
+        # Bisquare weights of the residuals.
+        std_resid = _np.abs(y - y_fit)
+        median = _np.median(std_resid)
+
+        if median == 0:
+            std_resid = (std_resid > 0).astype('float64')
+
+        else:
+            std_resid = std_resid / (6.0 * median)
+
+        std_resid = 1.0 - (_np.minimum(std_resid, 1.0) ** 2)
+        resid_weights = std_resid * std_resid
+
+    return(y_fit)
+
+
+def lowess_fold_rmse(x_trn, y_trn, x_tst, y_tst, frac):
+    """
+    Root mean squared error of a LOWESS fit (with the training subset)
+    on the testing subset.
+    """
+    y_trn_model = lowess_fit(x=x_trn, y=y_trn, frac=frac, it=3)
+    y_tst_model = _np.interp(
+        x=x_tst,
+        xp=x_trn,
+        fp=y_trn_model,
+        left=_np.nan,
+        right=_np.nan
+        )
+    return(_np.sqrt(_mse(y_true=y_tst, y_pred=y_tst_model)))
+
+
+def optimal_lowess(
+        x, y, fracs=11, xval_folds=3, random_seeds=range(3), workers=None
+        ):
+    """
+    LOWESS fit with the fraction of the data chosen by cross-validation.
+
+    The best fraction of each random seed is searched among
+    numpy.linspace(0, 1, fracs)[1:] and the mean of them is used in the
+    final fit. The training and testing subsets of every seed are built
+    once and shared by all the fractions.
+
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        The data (x sorted in ascending order).
+    fracs : int, optional
+        Number of points of the grid of fractions (0 included). By
+        default, 11.
+    xval_folds : int, optional
+        Number of folds of the cross-validation. By default, 3.
+    random_seeds : sequence of int, optional
+        Random seeds of the shuffling of the folds. By default,
+        range(3).
+    workers : int, optional
+        If given, the folds are fitted in parallel with this number of
+        processes. By default, None (serial).
+
+    Returns
+    -------
+    numpy.ndarray
+        The LOWESS fit: x and the fitted values of y in two columns (as
+        returned by statsmodels' lowess).
     """
     xmid = x[1:-1]
     ymid = y[1:-1]
@@ -20,42 +184,55 @@ def optimal_lowess(x, y, fracs=11, xval_folds=3, random_seeds=range(3)):
         stop=1,
         num=fracs
         )[1:]
-    crossval = {}
     best_seed_f = []
+    executor = None if workers is None else _ProcessPoolExecutor(workers)
 
-    for seed in random_seeds:
-        kf = _KFold(
-            n_splits=xval_folds,
-            shuffle=True,
-            random_state=seed
-            )
-
-        for f in f_tries:
-            rmse = []
-
-            for trn_fold, tst_fold in kf.split(ymid):
-                x_trn = _np.concatenate([[x[0]], xmid[trn_fold], [x[-1]]])
-                y_trn = _np.concatenate([[y[0]], ymid[trn_fold], [y[-1]]])
-                x_tst = xmid[tst_fold]
-                y_tst = ymid[tst_fold]
-                y_trn_model = _lowess(endog=y_trn, exog=x_trn, frac=f)[:, 1]
-                y_tst_model = _np.interp(
-                    x=x_tst,
-                    xp=x_trn,
-                    fp=y_trn_model,
-                    left=_np.nan,
-                    right=_np.nan
+    try:
+        for seed in random_seeds:
+            kf = _KFold(
+                n_splits=xval_folds,
+                shuffle=True,
+                random_state=seed
+                )
+            folds = [
+                (
+                    _np.concatenate([[x[0]], xmid[trn_fold], [x[-1]]]),
+                    _np.concatenate([[y[0]], ymid[trn_fold], [y[-1]]]),
+                    xmid[tst_fold],
+                    ymid[tst_fold]
                     )
-                rmse.append(_np.sqrt(_mse(y_true=y_tst, y_pred=y_tst_model)))
+                for trn_fold, tst_fold in kf.split(ymid)
+                ]
+
+            def crossval(i):
+                if executor is None:
+                    rmse = [
+                        lowess_fold_rmse(*fold, frac=f_tries[i])
+                        for fold in folds
+                        ]
+
+                else:
+                    rmse = list(executor.map(
+                        lowess_fold_rmse,
+                        *(list(zip(*folds)) + [[f_tries[i]] * len(folds)])
+                        ))
+
+                return(_np.mean(rmse))
 
-            crossval[f] = _np.mean(rmse)
+            best_seed_f.append(f_tries[min(
+                range(len(f_tries)),
+                key=crossval
+                )])
 
-        best_seed_f.append(
-            min(crossval.keys(), key=(lambda k: crossval[k]))
-            )
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     optimal_f = _np.mean(best_seed_f)
-    return(_lowess(endog=y, exog=x, frac=optimal_f))
+    return(_np.column_stack([
+        x,
+        lowess_fit(x=x, y=y, frac=optimal_f, it=3)
+        ]))
 
 
 def power_law(x, alpha, beta):
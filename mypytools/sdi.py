@@ -4,10 +4,27 @@ Created on Sun Nov 24 23:46:26 2019
 
 @author: r.realrangel
 """
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from pathlib import Path
+import numpy as np
+import xarray as xr
+from drought_t import data_manager as dmgr
+from scipy.stats import norm
+
+try:
+    from drought_t import spatial_analysis as span
+
+except ImportError:   # <- only needed to trim the output (trim_vmap).
+    span = None
+
+from .tseries import empirical_probability
+
 
 def compute_npsdi(
         data, temp_scale, index, variable, output_res, nodata=-32768,
-        trim_vmap=None
+        trim_vmap=None, chunks=None, workers=None, climatology=None
         ):
     """Compute non-parametric standardized drought indices (SDI).
 
@@ -78,12 +95,70 @@ def compute_npsdi(
     trim_vmap : str, optional
         Full path of a shapefile that contains the vector map used to
             trim the output dataset.
+    chunks : dict, optional
+        Size of the spatial tiles (e.g., {'lat': 50, 'lon': 50}). If
+        given, the index is computed lazily with dask (see
+        npsdi_chunked) and the returned dataset is dask-backed. By
+        default, None (the whole data cube is loaded in memory).
+    workers : int, optional
+        Number of processes used to compute the (month, tile) blocks
+        (see npsdi_parallel). If given, chunks sets the size of the
+        tiles instead of enabling dask. By default, None (serial).
+    climatology : str, optional
+        Full path of an .npz file with the records of each calendar
+        month. If it does not exist, the whole index is computed and
+        the file is created. If it exists, only the time steps of data
+        that are not in it yet are computed and added to it (see
+        npsdi_update). By default, None.
 
     Returns
     -------
     xarray.Dataset
         Dataset of the SDI computed.
     """
+    data_clean = npsdi_prepare(
+        data=data,
+        variable=variable
+        )
+    data_scaled = dmgr.accumulate_time(
+        data=data_clean,
+        t_acc=temp_scale
+        )
+    intensity = npsdi_intensity(
+        data=data_scaled,
+        index=index,
+        temp_scale=temp_scale,
+        chunks=chunks,
+        workers=workers,
+        climatology=climatology
+        )
+    return(npsdi_output(
+        intensity=intensity,
+        index=index,
+        temp_scale=temp_scale,
+        output_res=output_res,
+        nodata=nodata,
+        trim_vmap=trim_vmap
+        ))
+
+
+def npsdi_prepare(data, variable):
+    """Merge the mergeable variables and drop the unused ones.
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        The input datasets of MERRA-2 merged into one data cube (time,
+        lat, lon).
+    variable : sequence
+        A list of the MERRA-2's variable(s) name(s) used to compute the
+        index (see compute_npsdi).
+
+    Returns
+    -------
+    xarray.Dataset
+        The variables used to compute the index.
+    """
     # TODO: Remove the parameter 'variable' from the arguments and
     # define the variables names from the index to compute.
 
@@ -100,65 +175,131 @@ def compute_npsdi(
             vars_to_merge=[vars_to_merge]
             )
 
-    data_clean = dmgr.drop_array(
+    return(dmgr.drop_array(
         data=data,
         keeplst=variable
-        )
+        ))
 
-    data_scaled = dmgr.accumulate_time(
-        data=data_clean,
-        t_acc=temp_scale
-        )
 
-    inp_shape = list(
-        np.shape(data_scaled[data_scaled.var().keys()[0]].values)
-        )
-    intensity_aux = np.ndarray(inp_shape, dtype='float32') * np.nan
+def npsdi_intensity(
+        data, index, temp_scale, chunks=None, workers=None, climatology=None
+        ):
+    """Compute the non-parametric SDI of the accumulated variables.
 
-    for month in range(1, 13):
-        t_index = data_scaled.time.dt.month == month
-        time_series = get_time_series(
-            data=data_scaled,
-            month=month
+    Parameters
+    ----------
+    data : xarray.Dataset
+        The accumulated variables (time, lat, lon).
+    index : str
+        The name of the index to be computed.
+    temp_scale : int
+        The temporal scale to which the input data is aggregated.
+    chunks, workers, climatology : optional
+        Execution options (see compute_npsdi).
+
+    Returns
+    -------
+    xarray.DataArray
+        SDI (time, lat, lon), sorted by time.
+    """
+    if climatology is not None:
+        climatology = npsdi_store_path(climatology)
+
+    if climatology is not None and climatology.exists():
+        intensity = npsdi_update(
+            data=data,
+            filename=climatology
             )
 
-        for v, var in enumerate(time_series.var().iterkeys()):
-            var_data = np.expand_dims(time_series[var].values, axis=3)
+    elif workers is not None:
+        intensity = npsdi_parallel(
+            data=data,
+            tiles=chunks,
+            workers=workers,
+            message=(
+                "- Computing the {} index for a {}-month time "
+                "scale".format(index.upper(), temp_scale)
+                )
+            )
 
-            if v == 0:
-                rec_arranged = var_data.copy()
+    elif chunks is not None:
+        intensity = npsdi_chunked(
+            data=data,
+            chunks=chunks
+            )
 
-            else:
-                rec_arranged = np.concatenate(
-                    (rec_arranged, var_data.copy()),
-                    axis=3
-                    )
+    else:
+        variables = list(data.data_vars)
+        data = data.transpose('time', 'lat', 'lon')
+        inp_shape = list(np.shape(data[variables[0]].values))
+        intensity_aux = np.full(inp_shape, np.nan, dtype='float32')
 
-        P = empirical_probability(rec_arranged)
-        SDI = norm.ppf(P)
-        SDI[np.isnan(SDI)] = 0   # To fill near sore sea cells.
-        intensity_aux[t_index] = SDI
-        dmgr.progress_message(
-            current=month,
-            total=12,
-            message=(
-                "- Computing the {} index for a {}-month time scale".format(
-                    index.upper(), temp_scale
-                    )
-                ),
-            units='months'
+        for month in range(1, 13):
+            t_index = data.time.dt.month.values == month
+            time_series = data.isel(time=t_index)
+
+            for v, var in enumerate(variables):
+                var_data = np.expand_dims(time_series[var].values, axis=3)
+
+                if v == 0:
+                    rec_arranged = var_data.copy()
+
+                else:
+                    rec_arranged = np.concatenate(
+                        (rec_arranged, var_data.copy()),
+                        axis=3
+                        )
+
+            P = empirical_probability(rec_arranged)
+            SDI = norm.ppf(P)
+            SDI[np.isnan(SDI)] = 0   # To fill near sore sea cells.
+            intensity_aux[t_index] = SDI
+            dmgr.progress_message(
+                current=month,
+                total=12,
+                message=(
+                    "- Computing the {} index for a {}-month time "
+                    "scale".format(index.upper(), temp_scale)
+                    ),
+                units='months'
+                )
+
+        intensity = xr.DataArray(
+            data=intensity_aux,
+            coords={
+                'time': data.time.values,
+                'lat': data.lat.values,
+                'lon': data.lon.values
+                },
+            dims=['time', 'lat', 'lon']
             )
+        intensity = intensity.reindex({'time': sorted(intensity.time.values)})
 
-    intensity = xr.DataArray(
-        data=intensity_aux,
-        coords={
-            'time': data_scaled.time.values,
-            'lat': data_scaled.lat.values,
-            'lon': data_scaled.lon.values
-            },
-        dims=['time', 'lat', 'lon']
-        )
-    intensity = intensity.reindex({'time': sorted(intensity.time.values)})
+    if climatology is not None and not climatology.exists():
+        npsdi_climatology(
+            data=data,
+            filename=climatology
+            )
+
+    return(intensity)
+
+
+def npsdi_output(intensity, index, temp_scale, output_res, nodata, trim_vmap):
+    """Regrid and trim the SDI and define its attributes.
+
+    Parameters
+    ----------
+    intensity : xarray.DataArray
+        SDI (time, lat, lon).
+    index, temp_scale, output_res, nodata, trim_vmap
+        See compute_npsdi.
+
+    Returns
+    -------
+    xarray.DataArray
+        The output SDI.
+    """
+    intensity_interp_trimmed = intensity
 
     if output_res > 0:
         x_min = intensity.lon.min()
@@ -168,18 +309,25 @@ def compute_npsdi(
         out_lon = np.arange(x_min, x_max + output_res, output_res)
 #        out_lat = np.arange(y_min, y_max + output_res, output_res)
         out_lat = np.arange(y_min, y_max + output_res, output_res) + (output_res / 2)
-        intensity_interp = intensity.interp(lat=out_lat, lon=out_lon)
+        intensity_interp_trimmed = intensity.interp(lat=out_lat, lon=out_lon)
 
     # Trim the intensity_interp dataset.
     if trim_vmap is not None:
+        if span is None:
+            raise ImportError(
+                "drought_t.spatial_analysis is needed to trim the output "
+                "(trim_vmap)."
+                )
+
         intensity_interp_trimmed = span.trim_data(
-            data=intensity_interp,
+            data=intensity_interp_trimmed,
             vmap=trim_vmap,
             res=output_res,
             nodata=nodata
             )
 
     # Define global attributes
+    intensity_interp_trimmed = intensity_interp_trimmed.copy()
     global_attrs = OrderedDict()
     global_attrs['DroughtFeature'] = 'Drought_intensity'
     global_attrs['DroughtIndex'] = index
@@ -200,4 +348,457 @@ def compute_npsdi(
     lon_attrs['standard_name'] = "longitude"
     intensity_interp_trimmed.lon.attrs = lon_attrs
 
-    return(intensity_interp_trimmed)
\ No newline at end of file
+    return(intensity_interp_trimmed)
+
+
+def accumulate_scales(data, temp_scales):
+    """Accumulate the data to many temporal scales in one pass.
+
+    The accumulation of every scale is the difference of a single
+    cumulative sum over time (computed in float64), instead of one
+    moving sum per scale. A time step is NaN when its window is not
+    complete or contains missing values.
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        The variables (time, lat, lon).
+    temp_scales : sequence of int
+        The temporal scales (number of time steps to accumulate).
+
+    Returns
+    -------
+    dict
+        The accumulated dataset of each temporal scale.
+    """
+    data = data.astype('float64')
+    total = data.fillna(0).cumsum(dim='time')
+    missing = data.isnull().cumsum(dim='time')
+    position = xr.DataArray(
+        data=np.arange(len(data.time)),
+        coords={'time': data.time},
+        dims=['time']
+        )
+    output = {}
+
+    for scale in temp_scales:
+        window_total = total - total.shift(time=scale, fill_value=0)
+        window_missing = missing - missing.shift(time=scale, fill_value=0)
+        output[scale] = window_total.where(
+            (window_missing == 0) & (position >= (scale - 1))
+            )
+
+    return(output)
+
+
+def compute_npsdi_multiscale(
+        data, temp_scales, index, variable, output_res, nodata=-32768,
+        trim_vmap=None, chunks=None, workers=None
+        ):
+    """Compute a non-parametric SDI at many temporal scales.
+
+    The variables are merged and cleaned only once and the
+    accumulations of all the scales are built from a single cumulative
+    sum over time (see accumulate_scales).
+
+    Parameters
+    ----------
+    temp_scales : sequence of int
+        The temporal scales to which the input data is aggregated
+        (e.g., [1, 3, 6, 9, 12, 24]).
+    data, index, variable, output_res, nodata, trim_vmap, chunks, workers
+        See compute_npsdi.
+
+    Returns
+    -------
+    xarray.Dataset
+        Dataset of the SDI computed, with a 'scale' dimension.
+    """
+    data_clean = npsdi_prepare(
+        data=data,
+        variable=variable
+        )
+    data_scaled = accumulate_scales(
+        data=data_clean,
+        temp_scales=temp_scales
+        )
+    intensity = xr.concat(
+        [
+            npsdi_output(
+                intensity=npsdi_intensity(
+                    data=data_scaled[scale],
+                    index=index,
+                    temp_scale=scale,
+                    chunks=chunks,
+                    workers=workers
+                    ),
+                index=index,
+                temp_scale=scale,
+                output_res=output_res,
+                nodata=nodata,
+                trim_vmap=trim_vmap
+                )
+            for scale in temp_scales
+            ],
+        dim=xr.DataArray(data=list(temp_scales), dims=['scale'], name='scale')
+        )
+    intensity.attrs['TemporalScale'] = '{} month(s)'.format(
+        ', '.join([str(scale) for scale in temp_scales])
+        )
+    return(intensity.to_dataset(name=index))
+
+
+def npsdi_block(values):
+    """Compute the non-parametric SDI of a block of grid cells.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Accumulated values of the time steps of one calendar month. The
+        last two axes are time and variable; the rest are spatial.
+
+    Returns
+    -------
+    numpy.ndarray
+        The SDI, with the same shape as values without the variable
+        axis.
+    """
+    X = np.moveaxis(
+        values.reshape((-1, ) + np.shape(values)[-2:]),
+        source=1,
+        destination=0
+        )
+    P = empirical_probability(X[:, :, np.newaxis, :])
+    SDI = norm.ppf(P)
+    SDI[np.isnan(SDI)] = 0   # To fill near sore sea cells.
+    return(np.moveaxis(
+        SDI[:, :, 0],
+        source=0,
+        destination=1
+        ).reshape(np.shape(values)[:-1]).astype('float32'))
+
+
+def npsdi_chunked(data, chunks):
+    """Compute the non-parametric SDI lazily, by spatial tiles.
+
+    Every (month, tile) block is an independent dask task that only
+    loads its own part of the input, so memory use is bounded by the
+    size of the tiles and not by the size of the data cube. The result
+    is computed when it is loaded or written (e.g., with to_netcdf).
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        The accumulated variables (time, lat, lon). It can be backed by
+        numpy or dask arrays.
+    chunks : dict
+        Size of the spatial tiles (e.g., {'lat': 50, 'lon': 50}).
+
+    Returns
+    -------
+    xarray.DataArray
+        Dask-backed SDI (time, lat, lon), sorted by time.
+    """
+    records = data.to_array(dim='variable').chunk(
+        dict(chunks, time=-1, variable=-1)
+        )
+    intensity = records.groupby('time.month').map(
+        lambda group: xr.apply_ufunc(
+            npsdi_block,
+            group,
+            input_core_dims=[['time', 'variable']],
+            output_core_dims=[['time']],
+            dask='parallelized',
+            output_dtypes=['float32']
+            )
+        )
+    intensity = intensity.transpose('time', 'lat', 'lon').drop_vars(
+        'month',
+        errors='ignore'
+        )
+    return(intensity.sortby('time'))
+
+
+# Shared buffers attached by the worker processes of npsdi_parallel.
+shared_buffers = {}
+
+
+def npsdi_worker_init(records, intensity):
+    """Attach a worker process to the shared buffers of npsdi_parallel.
+
+    Parameters
+    ----------
+    records, intensity : tuple
+        Name, shape and dtype of the shared buffers of the input
+        records (time, lat, lon, variable) and the output SDI (time,
+        lat, lon).
+    """
+    for key, (name, shape, dtype) in zip(
+            ['records', 'intensity'], [records, intensity]
+            ):
+        buffer = shared_memory.SharedMemory(name=name)
+        shared_buffers[key] = (
+            buffer,
+            np.ndarray(shape, dtype=dtype, buffer=buffer.buf)
+            )
+
+
+def npsdi_task(t_index, lat_slice, lon_slice):
+    """Compute the SDI of a (month, tile) block of the shared buffers.
+
+    Parameters
+    ----------
+    t_index : numpy.ndarray
+        Positions of the time steps of the month.
+    lat_slice, lon_slice : slice
+        Extent of the tile.
+    """
+    records = shared_buffers['records'][1]
+    intensity = shared_buffers['intensity'][1]
+    P = empirical_probability(records[t_index, lat_slice, lon_slice])
+    SDI = norm.ppf(P)
+    SDI[np.isnan(SDI)] = 0   # To fill near sore sea cells.
+    intensity[t_index, lat_slice, lon_slice] = SDI
+
+
+def npsdi_parallel(data, tiles=None, workers=None, message=None):
+    """Compute the non-parametric SDI with a pool of processes.
+
+    The (month, tile) blocks are independent tasks. The input records
+    and the output SDI are kept in shared memory, so the workers read
+    and write them in place instead of receiving pickled copies of the
+    data cube. The results are identical to the serial computation.
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        The accumulated variables (time, lat, lon).
+    tiles : dict, optional
+        Size of the spatial tiles (e.g., {'lat': 50, 'lon': 50}). By
+        default, None (one tile per month).
+    workers : int, optional
+        Number of worker processes. By default, None (the number of
+        processors of the machine).
+    message : str, optional
+        Message of the progress report. By default, None (no report).
+
+    Returns
+    -------
+    xarray.DataArray
+        SDI (time, lat, lon), sorted by time.
+    """
+    variables = list(data.data_vars)
+    shape = (len(data.time), len(data.lat), len(data.lon))
+    tiles = dict({'lat': shape[1], 'lon': shape[2]}, **(tiles or {}))
+    buffers = []
+
+    try:
+        specs = []
+
+        for full_shape, dtype in [
+                (shape + (len(variables), ), 'float64'),
+                (shape, 'float32')
+                ]:
+            nbytes = int(np.prod(full_shape)) * np.dtype(dtype).itemsize
+            buffer = shared_memory.SharedMemory(
+                create=True,
+                size=max(1, nbytes)
+                )
+            buffers.append(buffer)
+            specs.append((buffer.name, full_shape, dtype))
+
+        records = np.ndarray(
+            specs[0][1],
+            dtype=specs[0][2],
+            buffer=buffers[0].buf
+            )
+
+        for v, var in enumerate(variables):
+            records[..., v] = data[var].transpose('time', 'lat', 'lon').values
+
+        tasks = [
+            (
+                np.where(data.time.dt.month.values == month)[0],
+                slice(lat, lat + tiles['lat']),
+                slice(lon, lon + tiles['lon'])
+                )
+            for month in range(1, 13)
+            for lat in range(0, shape[1], tiles['lat'])
+            for lon in range(0, shape[2], tiles['lon'])
+            ]
+
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=npsdi_worker_init,
+                initargs=tuple(specs)
+                ) as executor:
+            futures = [executor.submit(npsdi_task, *task) for task in tasks]
+
+            for t, future in enumerate(as_completed(futures)):
+                future.result()
+
+                if message is not None:
+                    dmgr.progress_message(
+                        current=(t + 1),
+                        total=len(tasks),
+                        message=message,
+                        units='blocks'
+                        )
+
+        intensity = xr.DataArray(
+            data=np.ndarray(
+                specs[1][1],
+                dtype=specs[1][2],
+                buffer=buffers[1].buf
+                ).copy(),
+            coords={
+                'time': data.time.values,
+                'lat': data.lat.values,
+                'lon': data.lon.values
+                },
+            dims=['time', 'lat', 'lon']
+            )
+
+    finally:
+        for buffer in buffers:
+            buffer.close()
+            buffer.unlink()
+
+    return(intensity.reindex({'time': sorted(intensity.time.values)}))
+
+
+def npsdi_store_path(filename):
+    """Path of the .npz file of the records of each calendar month.
+
+    numpy.savez_compressed adds the .npz suffix when it is missing, so
+    it is added here too to find the file actually written.
+    """
+    filename = Path(filename)
+
+    if filename.suffix != '.npz':
+        filename = filename.with_name(filename.name + '.npz')
+
+    return(filename)
+
+
+def npsdi_climatology(data, filename):
+    """Save the records of each calendar month used by npsdi_update.
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        The accumulated variables (time, lat, lon).
+    filename : str
+        Full path of the output .npz file.
+    """
+    variables = list(data.data_vars)
+    store = {
+        'variables': np.array(variables),
+        'lat': data.lat.values,
+        'lon': data.lon.values
+        }
+
+    for month in range(1, 13):
+        month_data = data.isel(time=(data.time.dt.month.values == month))
+        store['time_{}'.format(month)] = month_data.time.values
+        store['records_{}'.format(month)] = np.stack(
+            [
+                month_data[var].transpose('time', 'lat', 'lon').values
+                for var in variables
+                ],
+            axis=3
+            )
+
+    np.savez_compressed(file=npsdi_store_path(filename), **store)
+
+
+def npsdi_update(data, filename, a=0.44):
+    """Compute the non-parametric SDI of new time steps only.
+
+    The SDI of a new time step only depends on the records of the same
+    calendar month, which are kept in an .npz file (created with
+    npsdi_climatology). Every time step of data that is not in the
+    file yet is ranked against them and then added to the file, so
+    adding a month costs a single comparison against its climatology
+    instead of recomputing the whole history. For a single new time
+    step, the result is identical to the one of a full computation.
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        The accumulated variables (time, lat, lon). They and the grid
+        must be the ones of the file. The time steps that are already in
+        the file are skipped.
+    filename : str
+        Full path of the .npz file with the records of each calendar
+        month.
+    a : float, optional
+        Parameter a in the general formula for plotting possitions (see
+        empirical_probability). By default, 0.44.
+
+    Returns
+    -------
+    xarray.DataArray
+        SDI (time, lat, lon) of the new time steps, sorted by time.
+    """
+    filename = npsdi_store_path(filename)
+
+    with np.load(file=filename) as npz:
+        store = dict(npz)
+
+    variables = list(store['variables'])
+
+    if variables != list(data.data_vars) or not (
+            np.array_equal(store['lat'], data.lat.values) and
+            np.array_equal(store['lon'], data.lon.values)
+            ):
+        raise ValueError(
+            "The variables or the lat/lon grid of data differ from the "
+            "ones of {} (see npsdi_climatology).".format(filename)
+            )
+
+    months = dict(zip(data.time.values, data.time.dt.month.values))
+    new_times = sorted(
+        time
+        for time, month in months.items()
+        if time not in store['time_{}'.format(month)]
+        )
+    intensity = np.ndarray(
+        (len(new_times), len(store['lat']), len(store['lon'])),
+        dtype='float32'
+        )
+
+    for t, time in enumerate(new_times):
+        month = months[time]
+        new_records = np.stack(
+            [
+                data[var].sel(time=time).transpose('lat', 'lon').values
+                for var in variables
+                ],
+            axis=2
+            )
+        records = np.concatenate(
+            (store['records_{}'.format(month)], new_records[np.newaxis]),
+            axis=0
+            )
+        i = np.all(records <= new_records, axis=3).sum(axis=0)
+        n = np.all(np.isfinite(records), axis=3).sum(axis=0)
+        SDI = norm.ppf((i - a) / (n + 1 - (2 * a)))
+        SDI[np.isnan(SDI)] = 0   # To fill near sore sea cells.
+        intensity[t] = SDI
+        store['records_{}'.format(month)] = records
+        store['time_{}'.format(month)] = np.append(
+            store['time_{}'.format(month)],
+            time
+            )
+
+    np.savez_compressed(file=filename, **store)
+    return(xr.DataArray(
+        data=intensity,
+        coords={
+            'time': new_times,
+            'lat': store['lat'],
+            'lon': store['lon']
+            },
+        dims=['time', 'lat', 'lon']
+        ))
@@ -9,183 +9,786 @@ del Sistema de Información Agroalimentaria y Pesquera (SIAP;
 https://www.gob.mx/siap) de la Secretaría de Agricultura y Desarrollo
 Rural (SADER) de México.
 """
+from array import array as _array
+from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
 import datetime as _dt
+import functools as _functools
+import hashlib as _hashlib
+from html.parser import HTMLParser as _HTMLParser
+import inspect as _inspect
+from pathlib import Path as _Path
+import warnings as _warnings
+import numpy as _np
 import pandas as _pd
+from pandas.api.types import union_categoricals as _union_categoricals
+
+try:
+    import pyarrow as _pyarrow
+
+except ImportError:   # <- pyarrow es opcional (caché en Parquet).
+    _pyarrow = None
+
+
+# =============================================================================
+# Caché de archivos leídos
+# =============================================================================
+class DatasetCache():
+    """Caché en disco de las tablas leídas de los archivos del SIAP.
+
+    Cada tabla se guarda en Parquet si pyarrow está instalado o, si no,
+    en pickle (con un aviso, pues no es portable entre versiones de
+    pandas), con una clave de la ruta, la fecha de modificación y el
+    tamaño del archivo de origen y de los argumentos de lectura. Las
+    tablas se leen completas en memoria. Si el archivo cambia, la tabla
+    se vuelve a leer y la copia anterior se borra. Se activa con
+    enable_dataset_cache.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Carpeta de la caché. Por omisión, None (una carpeta .siap_cache
+        junto a cada archivo de origen).
+    fmt : str, optional
+        'parquet' o 'pickle'. Por omisión, None ('parquet' si pyarrow
+        está instalado; si no, 'pickle' con un aviso).
+    """
+    def __init__(self, directory=None, fmt=None):
+        if fmt is None and _pyarrow is None:
+            _warnings.warn(
+                'pyarrow is not installed; the dataset cache falls back '
+                'to pickle files'
+                )
+            fmt = 'pickle'
+
+        elif fmt is None:
+            fmt = 'parquet'
+
+        self.directory = directory
+        self.fmt = fmt
+        self.hits = 0
+        self.misses = 0
+
+    def filename(self, source, **parameters):
+        source = _Path(source).resolve()
+        status = source.stat()
+        directory = (
+            source.parent / '.siap_cache' if self.directory is None
+            else _Path(self.directory)
+            )
+        return(directory / '{}-{}-{}-{}.{}'.format(
+            source.name,
+            self._digest(str(source)),
+            self._digest(sorted(parameters.items())),
+            self._digest((status.st_mtime_ns, status.st_size)),
+            self.fmt
+            ))
+
+    def get(self, filename):
+        if filename.exists():
+            self.hits += 1
+
+            if self.fmt == 'parquet':
+                return(_pd.read_parquet(filename))
+
+            return(_pd.read_pickle(filename))
+
+        self.misses += 1
+        return(None)
+
+    def put(self, filename, data):
+        filename.parent.mkdir(parents=True, exist_ok=True)
+
+        # Borra las copias de versiones anteriores del archivo de origen.
+        for old in filename.parent.glob('{}-*.{}'.format(
+                filename.name.rsplit('-', 1)[0],
+                self.fmt
+                )):
+            old.unlink()
+
+        if self.fmt == 'parquet':
+            data.to_parquet(filename)
+
+        else:
+            data.to_pickle(filename)
+
+    def _digest(self, value):
+        return(_hashlib.sha1(repr(value).encode()).hexdigest()[:16])
+
+    def stats(self):
+        return({
+            'hits': self.hits,
+            'misses': self.misses
+            })
+
+
+# Caché de las funciones de lectura (None si está desactivada).
+dataset_cache = None
+
+
+def enable_dataset_cache(directory=None, fmt=None):
+    """Activa la caché de cierres_open_dataset y avances_open_dataset.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Carpeta de la caché. Por omisión, None (una carpeta .siap_cache
+        junto a cada archivo de origen).
+    fmt : str, optional
+        'parquet' o 'pickle'. Por omisión, None ('parquet' si pyarrow
+        está instalado; si no, 'pickle' con un aviso).
+
+    Returns
+    -------
+    DatasetCache.
+
+    """
+    global dataset_cache
+    dataset_cache = DatasetCache(directory=directory, fmt=fmt)
+    return(dataset_cache)
+
+
+def disable_dataset_cache():
+    """Desactiva la caché de las funciones de lectura."""
+    global dataset_cache
+    dataset_cache = None
+
+
+def cache_dataset(function):
+    """Busca en dataset_cache, si está activada, las tablas leídas por
+    una función cuyo primer argumento es la ruta del archivo."""
+    signature = _inspect.signature(function)
+
+    @_functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if dataset_cache is None:
+            return(function(*args, **kwargs))
+
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        parameters = dict(arguments.arguments)
+        cached = dataset_cache.filename(
+            parameters.pop(list(signature.parameters)[0]),
+            function=function.__name__,
+            **parameters
+            )
+        data = dataset_cache.get(cached)
+
+        if data is None:
+            data = function(*args, **kwargs)
+            dataset_cache.put(cached, data)
+
+        return(data)
+
+    return(wrapper)
+
+
+# =============================================================================
+# Varios archivos
+# =============================================================================
+def _try_open(args):
+    open_dataset, filename, kwargs = args
+
+    try:
+        return(open_dataset(filename, **kwargs), None)
+
+    except Exception as err:
+        return(None, '{}: {}'.format(type(err).__name__, err))
+
+
+def harmonize_categoricals(frames):
+    """Unifica las categorías de las columnas categóricas de varias tablas.
+
+    Así, pandas.concat conserva el tipo categórico en lugar de convertir
+    las columnas a object.
+
+    Parameters
+    ----------
+    frames : list of pandas.DataFrame
+        Tablas por unir.
+
+    Returns
+    -------
+    list of pandas.DataFrame.
+
+    """
+    columns = {
+        column
+        for frame in frames
+        for column in frame.columns
+        if isinstance(frame[column].dtype, _pd.CategoricalDtype)
+        }
+    frames = [frame.copy(deep=False) for frame in frames]
+
+    for column in columns:
+        for frame in frames:
+            if column in frame.columns and not isinstance(
+                    frame[column].dtype, _pd.CategoricalDtype
+                    ):
+                frame[column] = frame[column].astype('category')
+
+        categories = _union_categoricals([
+            frame[column]
+            for frame in frames
+            if column in frame.columns
+            ]).categories
+
+        for frame in frames:
+            if column in frame.columns:
+                frame[column] = frame[column].cat.set_categories(categories)
+
+    return(frames)
+
+
+def open_mfdataset(
+        open_dataset, paths, workers=None, pool='thread', skip_errors=False,
+        **kwargs
+        ):
+    """Abre y une varios archivos con un conjunto de hilos o procesos.
+
+    Las tablas se unen en el orden de paths, sin importar el orden en
+    que terminan de leerse.
+
+    Parameters
+    ----------
+    open_dataset : callable
+        Función que abre un archivo (p. ej., cierres_open_dataset).
+    paths : list of str
+        Rutas completas de los archivos de entrada.
+    workers : int, optional
+        Número de hilos o procesos. Si es 1, los archivos se leen uno
+        tras otro. Por omisión, None (el de concurrent.futures).
+    pool : str, optional
+        'thread' o 'process'. Por omisión, 'thread'.
+    skip_errors : bool, optional
+        Si es True, los archivos que no se pueden leer se omiten con una
+        advertencia. Por omisión, False.
+    **kwargs
+        Otros argumentos de open_dataset.
+
+    Returns
+    -------
+    pandas.DataFrame.
+
+    """
+    tasks = [(open_dataset, filename, kwargs) for filename in paths]
+
+    if workers == 1:
+        results = [_try_open(task) for task in tasks]
+
+    else:
+        executor = (
+            _ThreadPoolExecutor if pool == 'thread' else _ProcessPoolExecutor
+            )
+
+        with executor(max_workers=workers) as pool_executor:
+            results = list(pool_executor.map(_try_open, tasks))
+
+    frames = []
+
+    for filename, (data, error) in zip(paths, results):
+        if error is None:
+            frames.append(data)
+
+        elif skip_errors:
+            _warnings.warn('{} was skipped ({})'.format(filename, error))
+
+        else:
+            raise IOError('{} could not be read ({})'.format(filename, error))
+
+    return(_pd.concat(harmonize_categoricals(frames)))
 
 
 # =============================================================================
 # Cierres de ciclo
 # =============================================================================
-def cierres_open_dataset(filename):
+CIERRES_FLOAT_COLUMNS = [
+    'Sembrada', 'Cosechada', 'Siniestrada', 'Volumenproduccion',
+    'Rendimiento', 'Precio', 'Valorproduccion'
+    ]
+
+
+def cierres_schema(columns):
+    """Define los tipos de las columnas de un archivo de cierres.
+
+    Las columnas 'Id*' (y 'Anio') y las de superficie, producción y
+    valor se leen como flotantes y las 'Nom*' como categóricas. Las demás
+    se dejan a la inferencia de pandas.
+
+    Parameters
+    ----------
+    columns : list of str
+        Nombres de las columnas.
+
+    Returns
+    -------
+    dict.
+
+    """
+    schema = {}
+
+    for column in columns:
+        if (column.startswith('Id') or column == 'Anio' or
+                column in CIERRES_FLOAT_COLUMNS):
+            schema[column] = 'float64'
+
+        elif column.startswith('Nom'):
+            schema[column] = 'category'
+
+    return(schema)
+
+
+@cache_dataset
+def cierres_open_dataset(filename, usecols=None, engine='c'):
     """Abre un archivo de cierres agrícolas del SIAP.
 
+    Los tipos de las columnas se fijan de antemano (ver cierres_schema)
+    y las columnas 'Id*' (y 'Anio') sin valores faltantes se reducen al
+    menor tipo entero que las contiene (p. ej., int8 para 'Idestado').
+
     Parameters
     ----------
     filename : str
         Ruta completa del archivo de entrada.
+    usecols : list of str, optional
+        Columnas por leer. Por omisión, None (todas).
+    engine : str, optional
+        Motor de lectura de pandas.read_csv ('c' o, si está instalado,
+        'pyarrow'). Por omisión, 'c'.
 
     Returns
     -------
     pandas.DataFrame.
 
     """
-    return(_pd.read_csv(
+    columns = _pd.read_csv(
         filepath_or_buffer=filename,
         encoding='latin',
-        low_memory=False
+        nrows=0
+        ).columns
+
+    if usecols is not None:
+        columns = [i for i in columns if i in usecols]
+
+    schema = cierres_schema(columns)
+    data = _pd.read_csv(
+        filepath_or_buffer=filename,
+        encoding='latin',
+        usecols=columns,
+        dtype=schema,
+        engine=engine
+        )
+
+    for column in schema:
+        if ((column.startswith('Id') or column == 'Anio') and
+                not data[column].isna().any()):
+            data[column] = _pd.to_numeric(
+                data[column],
+                downcast='integer'
+                )
+
+    return(data)
+
+
+def cierres_open_mfdataset(
+        paths, usecols=None, workers=None, pool='thread', skip_errors=False
+        ):
+    """Abre y une varios archivos de cierres agrícolas del SIAP.
+
+    Ver open_mfdataset y cierres_open_dataset.
+    """
+    return(open_mfdataset(
+        open_dataset=cierres_open_dataset,
+        paths=paths,
+        workers=workers,
+        pool=pool,
+        skip_errors=skip_errors,
+        usecols=usecols
         ))
 
 
-def cierres_open_mfdataset(paths):
-    return(_pd.concat([
-        cierres_open_dataset(filename)
-        for filename in paths
-        ]))
+class CierresIndex():
+    """Índice de un conjunto de datos de cierres para extraer subconjuntos.
+
+    Para cada columna consultada se guardan, una sola vez, las posiciones
+    de los renglones de cada valor (los nombres en minúsculas), de modo
+    que cada consulta se resuelve con búsquedas en diccionarios e
+    intersecciones de posiciones, sin copiar la tabla completa.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Cierres agrícolas del SIAP (ver cierres_open_dataset).
+    """
+    keys = {
+        'estado': ('Nomestado', 'Idestado'),
+        'ddr': ('Nomddr', 'Idddr'),
+        'cicloproductivo': ('Nomcicloproductivo', 'Idciclo'),
+        'modalidad': ('Nommodalidad', 'Idmodalidad'),
+        'cultivo': ('Nomcultivo', 'Idcultivo'),
+        }
+
+    def __init__(self, data):
+        self.data = data
+        self._positions = {}
+
+    def positions(self, key, values):
+        """Posiciones (ordenadas) de los renglones con alguno de los
+        valores (nombres o claves numéricas) de key."""
+        if _np.ndim(values) == 0:
+            values = [values]
+
+        name, number = self.keys[key]
+        output = []
+
+        for value in values:
+            if isinstance(value, str):
+                index = self._index(name, lower=True)
+                value = value.lower()
+
+            else:
+                index = self._index(number)
+
+            output.append(index.get(value, _np.array([], dtype='int64')))
+
+        if len(output) == 1:
+            return(output[0])
+
+        output = _np.sort(_np.concatenate(output))
+        return(output[_np.diff(output, prepend=-1) != 0])
+
+    def subset(
+            self, estado=None, ddr=None, cicloproductivo=None,
+            modalidad=None, cultivo=None, clean=False, onlynom=False
+            ):
+        """Extrae un subconjunto (ver cierres_subset)."""
+        queries = {
+            'estado': estado,
+            'ddr': ddr,
+            'cicloproductivo': cicloproductivo,
+            'modalidad': modalidad,
+            'cultivo': cultivo
+            }
+        rows = None
+
+        for key, values in queries.items():
+            if not values:
+                continue
+
+            positions = self.positions(key, values)
+
+            if rows is None:
+                rows = positions
+
+            else:
+                selected = _np.zeros(len(self.data), dtype='bool')
+                selected[positions] = True
+                rows = rows[selected[rows]]
+
+        sub = self.data.copy() if rows is None else self.data.iloc[rows]
+
+        if clean:
+            sub = sub.drop(
+                labels=sub.columns[(sub.nunique() == 1).values],
+                axis=1
+                )
+
+        if onlynom:
+            sub = sub.drop(
+                labels=[f for f in sub.columns if f.startswith('Id')],
+                axis=1
+                )
+
+        return(sub)
+
+    def _index(self, column, lower=False):
+        if column not in self._positions:
+            codes, uniques = _pd.factorize(self.data[column])
+
+            if lower:
+                lower_codes, uniques = _pd.factorize(
+                    _pd.Index(uniques).str.lower()
+                    )
+                codes = _np.where(codes >= 0, lower_codes[codes], -1)
+
+            order = _np.argsort(codes, kind='stable')
+            bounds = _np.searchsorted(
+                codes[order],
+                _np.arange(len(uniques) + 1)
+                )
+            self._positions[column] = {
+                value: order[bounds[i]:bounds[i + 1]]
+                for i, value in enumerate(uniques)
+                }
+
+        return(self._positions[column])
 
 
 def cierres_subset(
         data, estado=None, ddr=None, cicloproductivo=None, modalidad=None,
         cultivo=None, clean=False, onlynom=False,
         ):
-    sub = data.copy()
+    """Extrae un subconjunto de los cierres agrícolas del SIAP.
 
-    if estado:
-        if isinstance(estado, str):
-            sub = sub[sub['Nomestado'].str.lower() == estado.lower()]
+    Para muchas consultas sobre la misma tabla, conviene preparar una
+    sola vez su índice (CierresIndex) y pasarlo como data.
 
-        elif isinstance(estado, (int, float)):
-            sub = sub[sub['Idestado'] == estado]
+    Parameters
+    ----------
+    data : pandas.DataFrame or CierresIndex
+        Cierres agrícolas del SIAP.
+    estado, ddr, cicloproductivo, modalidad, cultivo : optional
+        Nombre (sin distinguir mayúsculas) o clave numérica, o una lista
+        de ellos. Por omisión, None (todos).
+    clean : bool, optional
+        Si es True, se quitan las columnas con un solo valor. Por
+        omisión, False.
+    onlynom : bool, optional
+        Si es True, se quitan las columnas 'Id*'. Por omisión, False.
 
-    if ddr:
-        if isinstance(ddr, str):
-            sub = sub[sub['Nomddr'].str.lower() == ddr.lower()]
+    Returns
+    -------
+    pandas.DataFrame.
 
-        elif isinstance(ddr, (int, float)):
-            sub = sub[sub['Idddr'] == ddr]
+    """
+    if not isinstance(data, CierresIndex):
+        data = CierresIndex(data)
 
-    if cicloproductivo:
-        if isinstance(cicloproductivo, str):
-            sub = sub[sub['Nomcicloproductivo'].str.lower() ==
-                      cicloproductivo.lower()]
+    return(data.subset(
+        estado=estado,
+        ddr=ddr,
+        cicloproductivo=cicloproductivo,
+        modalidad=modalidad,
+        cultivo=cultivo,
+        clean=clean,
+        onlynom=onlynom
+        ))
 
-        elif isinstance(cicloproductivo, (int, float)):
-            sub = sub[sub['Idciclo'] == cicloproductivo]
 
-    if modalidad:
-        if isinstance(modalidad, str):
-            sub = sub[sub['Nommodalidad'].str.lower() == modalidad.lower()]
+# =============================================================================
+# Avances mensuales (2006-presente)
+# =============================================================================
+AVANCES_MONTHS = {
+    month: m + 1
+    for m, month in enumerate(
+        'ENERO FEBRERO MARZO ABRIL MAYO JUNIO JULIO AGOSTO SEPTIEMBRE '
+        'OCTUBRE NOVIEMBRE DICIEMBRE'.split()
+        )
+    }
 
-        elif isinstance(modalidad, (int, float)):
-            sub = sub[sub['Idmodalidad'] == modalidad]
 
-    if cultivo:
-        if isinstance(cultivo, str):
-            sub = sub[sub['Nomcultivo'].str.lower() == cultivo.lower()]
+class AvancesParser(_HTMLParser):
+    """Lector en un solo recorrido de los reportes de avances del SIAP.
 
-        elif isinstance(cultivo, (int, float)):
-            sub = sub[sub['Idcultivo'] == cultivo]
+    Recorre el documento una vez (se le puede alimentar por partes con
+    feed) y guarda, de cada tabla de siete columnas, los renglones de
+    distritos junto con los títulos que la preceden (elementos de clase
+    textoTablaTitulo) en listas por columna.
+    """
+    def __init__(self):
+        super().__init__()
+        self.columns = {
+            key: []
+            for key in 'ANO CORTE ESTADO DISTRITO CULTIVO CICLO MOD'.split()
+            }
+        self.values = _array('d')
+        self._tables = []
+        self._titles = []
+        self._title = None
+        self._text = []
 
-    if clean:
-        sub.drop(
-            labels=sub.columns[(sub.nunique() == 1).values],
-            axis=1,
-            inplace=True
-            )
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        attrs = dict(attrs)
+        name = attrs.get('class') or ''
 
-    if onlynom:
-        sub.drop(
-            labels=[f for f in sub.columns if f.startswith('Id')],
-            axis=1,
-            inplace=True
-            )
+        # Elemento de título abierto: [etiqueta, anidamiento].
+        if self._title is None:
+            if 'textoTabla' in name and 'titulo' in name.lower():
+                self._title = [tag, 1]
+                self._titles.append([])
 
-    return(sub)
+        elif tag == self._title[0]:
+            self._title[1] += 1
 
+        if tag == 'table':
+            self._tables.append({'rows': [], 'spans': {}, 'row': None})
 
-# =============================================================================
-# Avances mensuales (2006-presente)
-# =============================================================================
-def avances_open_dataset(filename):
-    def str2DatetimeIndex(date_str):
-        keys = (
-            'ENERO FEBRERO MARZO ABRIL MAYO JUNIO JULIO AGOSTO SEPTIEMBRE '
-            'OCTUBRE NOVIEMBRE DICIEMBRE'.split()
-            )
-        vals = [i for i in list(range(1, 13))]
-        month_str2int = {k: v for k, v in zip(keys, vals)}
-        date_str = date_str.split()
-        return(_dt.date(
-            int(date_str[6]),
-            month_str2int[date_str[4]],
-            int(date_str[2])
-            ))
+        elif not self._tables:
+            return
 
-    output = []
-    tables = [
-        df.copy()
-        for df in _pd.read_html(io=str(filename))
-        if df.shape[1] == 7
-        ]
+        elif tag == 'tr':
+            self._tables[-1]['row'] = []
 
-    with open(file=str(filename), mode='r') as html_file:
-        html_script = html_file.read().splitlines()
+        elif tag in ('td', 'th') and self._tables[-1]['row'] is not None:
+            self._tables[-1]['row'].append([
+                tag,
+                int(attrs.get('colspan') or 1),
+                int(attrs.get('rowspan') or 1),
+                []
+                ])
 
-    table_metadata = [
-        i
-        for i in html_script
-        if "textoTablaTitulo" in i
-        ]
+    def handle_endtag(self, tag):
+        self._flush()
 
-    for t, table in enumerate(tables):
-        # Parse the data.
-        table = table[[
-            'TOTAL' not in i.split()
-            for i in table['Distrito']['Distrito']
-            ]]
-        table.columns = (
-            'ESTADO DISTRITO SEMBRADO_HA COSECHADO_HA SINIESTRADO_HA '
-            'OBTENIDO_TON RBC_TON/HA'.split()
-            )
-        table['ESTADO'] = table['ESTADO'].fillna(method='ffill')
-
-        # Parse the metadata.
-        titles = [
-            i for i in table_metadata[t].split("textoTabla")
-            if "titulo" in i.lower()
-            ][-2:]
-        metadata = [
-            i for i in [
-                i.split(">")[-1].strip()
-                for i in titles[0].split("<") + titles[1].split("<")
-                ]
-            if i
-            ]
-        table['CICLO'] = metadata[0]
-        table['ANO'] = int(metadata[1])
-        table['MOD'] = metadata[2]
-        table['CORTE'] = str2DatetimeIndex(date_str=metadata[3])
-        table['CULTIVO'] = metadata[5]
-        output.append(
-            table.loc[
-                :,
-                'ANO CORTE ESTADO DISTRITO CULTIVO CICLO MOD SEMBRADO_HA '
-                'COSECHADO_HA SINIESTRADO_HA OBTENIDO_TON'.split()
-                ]
+        if self._title is not None and tag == self._title[0]:
+            self._title[1] -= 1
+
+            if not self._title[1]:
+                self._title = None
+
+        if not self._tables:
+            return
+
+        table = self._tables[-1]
+
+        if tag == 'tr' and table['row'] is not None:
+            table['rows'].append(self._expand(table, table['row']))
+            table['row'] = None
+
+        elif tag == 'table':
+            self._tables.pop()
+
+            if table['rows'] and max(map(len, table['rows'])) == 7:
+                self._store(table['rows'])
+
+    def handle_data(self, data):
+        # Un texto puede llegar en varias partes entre dos bloques.
+        self._text.append(data)
+
+    def _flush(self):
+        data = ''.join(self._text).strip()
+        self._text = []
+
+        if not data:
+            return
+
+        if self._title is not None:
+            self._titles[-1].append(data)
+
+        if self._tables and self._tables[-1]['row']:
+            self._tables[-1]['row'][-1][3].append(data)
+
+    def _expand(self, table, cells):
+        """Pares (etiqueta, texto) de las columnas de un renglón, con las
+        celdas repetidas según sus colspan y rowspan (como read_html)."""
+        row = []
+        spans = table['spans']
+        cells = list(cells)
+
+        while cells or len(row) in spans:
+            if len(row) in spans:
+                remaining, tag, text = spans[len(row)]
+                row.append((tag, text))
+
+                if remaining == 1:
+                    del spans[len(row) - 1]
+
+                else:
+                    spans[len(row) - 1] = (remaining - 1, tag, text)
+
+                continue
+
+            tag, colspan, rowspan, text = cells.pop(0)
+            text = ' '.join(' '.join(text).split())
+
+            for _ in range(colspan):
+                if rowspan > 1:
+                    spans[len(row)] = (rowspan - 1, tag, text)
+
+                row.append((tag, text))
+
+        return(row)
+
+    def _store(self, rows):
+        # Ciclo, año, modalidad y fecha de corte, y cultivo.
+        ciclo, ano, mod, date = self._titles[-2][:4]
+        cultivo = self._titles[-1][0]
+        date = date.split()
+        corte = _dt.date(
+            int(date[6]),
+            AVANCES_MONTHS[date[4]],
+            int(date[2])
             )
+        estado = None
 
-    output = _pd.concat(output)
-    output.set_index(
-        keys='CORTE',
-        inplace=True
-        )
+        for row in rows:
+            # Se omiten los encabezados y los totales.
+            if (all(tag == 'th' for tag, text in row) or len(row) != 7 or
+                    'TOTAL' in row[1][1].split()):
+                continue
 
-    return(output)
+            estado = row[0][1] or estado
+            self.columns['ANO'].append(int(ano))
+            self.columns['CORTE'].append(corte)
+            self.columns['ESTADO'].append(estado)
+            self.columns['DISTRITO'].append(row[1][1])
+            self.columns['CULTIVO'].append(cultivo)
+            self.columns['CICLO'].append(ciclo)
+            self.columns['MOD'].append(mod)
+
+            for tag, text in row[2:6]:
+                try:
+                    self.values.append(float(text.replace(',', '')))
 
+                except ValueError:
+                    self.values.append(float('nan'))
 
-def avances_open_mfdataset(paths):
-    return(_pd.concat([
-        avances_open_dataset(filename) for filename in paths
-        ]))
+    def to_dataframe(self):
+        values = _np.frombuffer(self.values, dtype='float64').reshape(-1, 4)
+        output = _pd.DataFrame(self.columns)
+
+        for c, column in enumerate(
+                'SEMBRADO_HA COSECHADO_HA SINIESTRADO_HA OBTENIDO_TON'.split()
+                ):
+            output[column] = values[:, c]
+
+        return(output.set_index(keys='CORTE'))
+
+
+@cache_dataset
+def avances_open_dataset(filename, blocksize=2**20):
+    """Abre un reporte de avances mensuales del SIAP (HTML).
+
+    El archivo se lee por bloques y se recorre una sola vez (ver
+    AvancesParser).
+
+    Parameters
+    ----------
+    filename : str
+        Ruta completa del archivo de entrada.
+    blocksize : int, optional
+        Número de caracteres leídos a la vez. Por omisión, 2**20.
+
+    Returns
+    -------
+    pandas.DataFrame.
+
+    """
+    parser = AvancesParser()
+
+    with open(file=str(filename), mode='r') as html_file:
+        for block in iter(lambda: html_file.read(blocksize), ''):
+            parser.feed(block)
+
+    parser.close()
+    return(parser.to_dataframe())
+
+
+def avances_open_mfdataset(
+        paths, workers=None, pool='thread', skip_errors=False
+        ):
+    """Abre y une varios reportes de avances mensuales del SIAP.
+
+    Ver open_mfdataset y avances_open_dataset.
+    """
+    return(open_mfdataset(
+        open_dataset=avances_open_dataset,
+        paths=paths,
+        workers=workers,
+        pool=pool,
+        skip_errors=skip_errors
+        ))
 
 
 def avances_subset(
@@ -218,36 +821,229 @@ def avances_subset(
     return(sub)
 
 
-def avances_fillna(data):
-    data_filled = data.copy()
-    data_filled[data_filled.isna()] = 0
-    data_filled = data_filled.reindex(
-        index=_pd.date_range(
-            start=data_filled.index[0],
-            end=data_filled.index[-1],
-            freq='M'
+def avances_fillna(data, by=None):
+    """Completa los meses faltantes de series de avances mensuales.
+
+    Los valores faltantes de los reportes se toman como cero y los de los
+    meses sin reporte se interpolan linealmente dentro de cada año
+    agrícola ('ANO', que comienza en abril) de cada serie. Las columnas
+    no numéricas (p. ej., 'ESTADO') toman en esos meses el valor del
+    reporte anterior de la serie. Todas las series se procesan a la vez
+    con operaciones vectorizadas.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Avances mensuales indexados por la fecha de corte.
+    by : str or list of str, optional
+        Columnas que identifican cada serie de una tabla larga (p. ej.,
+        ['ESTADO', 'DISTRITO', 'CULTIVO', 'CICLO', 'MOD']). Por omisión,
+        None (una sola serie).
+
+    Returns
+    -------
+    pandas.DataFrame.
+
+    """
+    by = [] if by is None else ([by] if isinstance(by, str) else list(by))
+    columns = [
+        i
+        for i in data.columns
+        if i not in by and i != 'ANO' and
+        _pd.api.types.is_numeric_dtype(data[i])
+        ]
+    others = [
+        i
+        for i in data.columns
+        if i not in by and i != 'ANO' and i not in columns
+        ]
+    dates = _pd.DatetimeIndex(data.index)
+    months = (dates.year * 12 + dates.month - 1).values
+
+    if by:
+        codes = data.groupby(by=by, sort=False).ngroup().values
+
+    else:
+        codes = _np.zeros(len(data), dtype='int64')
+
+    # Meses de cada serie, del primero al último reporte.
+    groups = codes.max() + 1
+    first = _np.full(groups, months.max())
+    last = _np.full(groups, months.min())
+    _np.minimum.at(first, codes, months)
+    _np.maximum.at(last, codes, months)
+    lengths = last - first + 1
+    offsets = _np.concatenate([[0], _np.cumsum(lengths)[:-1]])
+    total = lengths.sum()
+    group = _np.repeat(_np.arange(groups), lengths)
+    month = (
+        _np.arange(total) - _np.repeat(offsets, lengths) +
+        _np.repeat(first, lengths)
+        )
+    rows = offsets[codes] + months - first[codes]
+
+    # Año agrícola de los meses sin reporte.
+    ano = (month // 12 - (month % 12 < 3)).astype('float64')
+
+    if 'ANO' in data.columns:
+        ano[rows] = data['ANO'].fillna(0).values
+
+    values = _np.full((total, len(columns)), _np.nan)
+    values[rows] = data[columns].fillna(0).values
+
+    # Interpolación por tramos (serie, año agrícola), por posición.
+    order = _np.lexsort((_np.arange(total), ano, group))
+    position = _np.arange(total)
+    change = _np.ones(total, dtype='bool')
+    change[1:] = (
+        (group[order][1:] != group[order][:-1]) |
+        (ano[order][1:] != ano[order][:-1])
+        )
+    segment_first = _np.maximum.accumulate(_np.where(change, position, 0))
+    segment_last = _np.minimum.accumulate(_np.where(
+        _np.append(change[1:], True), position, total
+        )[::-1])[::-1]
+    sorted_values = values[order]
+    valid = ~_np.isnan(sorted_values)
+    position = position.reshape(-1, 1)
+    previous = _np.maximum.accumulate(_np.where(valid, position, -1))
+    following = _np.minimum.accumulate(
+        _np.where(valid, position, total)[::-1]
+        )[::-1]
+    has_previous = previous >= segment_first.reshape(-1, 1)
+    has_following = following <= segment_last.reshape(-1, 1)
+    value_previous = _np.take_along_axis(
+        sorted_values,
+        _np.clip(previous, 0, None),
+        axis=0
+        )
+    value_following = _np.take_along_axis(
+        sorted_values,
+        _np.clip(following, None, total - 1),
+        axis=0
+        )
+    values[order] = _np.where(
+        has_previous & has_following,
+        value_previous + (value_following - value_previous) * (
+            (position - previous) /
+            _np.maximum(following - previous, 1)
+            ),
+        _np.where(has_previous, value_previous, _np.nan)
+        )
+
+    output = _pd.DataFrame(
+        data=values,
+        columns=columns,
+        index=_pd.DatetimeIndex(
+            (month - 1970 * 12 + 1).astype('datetime64[M]') -
+            _np.timedelta64(1, 'D'),
+            name=data.index.name
             )
         )
-    data_filled.loc[
-        (data_filled['ANO'].isna()) & (data_filled.index.month >= 4), 'ANO'
-        ] = data_filled.loc[
-            (data_filled['ANO'].isna()) & (data_filled.index.month >= 4)
-            ].index.year.values
-    data_filled.loc[
-        (data_filled['ANO'].isna()) & (data_filled.index.month <= 3), 'ANO'
-        ] = data_filled.loc[
-            (data_filled['ANO'].isna()) & (data_filled.index.month <= 3)
-            ].index.year.values - 1
-    data_filled = data_filled.groupby(by='ANO').apply(
-        lambda group: group.interpolate()
+    output.insert(0, 'ANO', ano)
+
+    # Columnas no numéricas: valor del reporte anterior de la serie.
+    source = _np.full(total, -1)
+    source[rows] = _np.arange(len(rows))
+    previous = _np.maximum.accumulate(
+        _np.where(source >= 0, _np.arange(total), -1)
+        )
+
+    for column in others:
+        output[column] = data[column].values[source[previous]]
+
+    for column in by[::-1]:
+        output.insert(
+            0,
+            column,
+            data[column].values[_np.unique(codes, return_index=True)[1]][
+                group
+                ]
+            )
+
+    if 'ANO' in data.columns:
+        output = output[data.columns]
+
+    else:
+        output = output[by + ['ANO'] + [
+            i for i in data.columns if i not in by
+            ]]
+
+    return(output)
+
+
+def avances_monthly_weight(data, by=None, workers=None):
+    """Pesos mensuales de exposición de series de avances mensuales.
+
+    Los avances de cada año agrícola se normalizan con su último reporte,
+    se promedian por mes y se clipean a [0, 1]. La exposición de cada mes
+    es la diferencia entre lo sembrado y lo cosechado, normalizada para
+    que sume uno en cada serie.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Avances mensuales indexados por la fecha de corte (ver
+        avances_fillna), con las columnas 'ANO', 'SEMBRADO_HA' y
+        'COSECHADO_HA'.
+    by : str or list of str, optional
+        Columnas que identifican cada serie de una tabla larga (p. ej.,
+        ['ESTADO', 'DISTRITO', 'CULTIVO']). Por omisión, None (una sola
+        serie).
+    workers : int, optional
+        Número de procesos entre los que se reparten las series. Por
+        omisión, None (en el proceso actual).
+
+    Returns
+    -------
+    pandas.Series or pandas.DataFrame
+        Pesos por mes o, con by, una tabla con una serie por renglón y
+        un mes por columna.
+
+    """
+    by = [] if by is None else ([by] if isinstance(by, str) else list(by))
+
+    if by and workers is not None and workers > 1:
+        codes = data.groupby(by=by, sort=False).ngroup().values % workers
+        parts = [data[codes == part] for part in range(workers)]
+
+        with _ProcessPoolExecutor(max_workers=workers) as executor:
+            return(_pd.concat(executor.map(
+                avances_monthly_weight,
+                [part for part in parts if len(part)],
+                [by] * workers
+                )).sort_index())
+
+    columns = ['SEMBRADO_HA', 'COSECHADO_HA']
+    keys = [data[column].values for column in by] + [data['ANO'].values]
+    groups = _pd.DataFrame(dict(enumerate(keys))).groupby(
+        by=list(range(len(keys))),
+        sort=False
         )
-    return(data_filled)
 
+    # Último reporte de cada año agrícola de cada serie.
+    codes = groups.ngroup().values
+    rows = _np.flatnonzero(groups.cumcount(ascending=False).values == 0)
+    last = _np.zeros(codes.max() + 1, dtype='int64')
+    last[codes[rows]] = rows
+    values = data[columns].values
 
-def avances_monthly_weight(data):
-    mean_advance = data.groupby(by='ANO').apply(
-        lambda table: table / table.iloc[-1]
-        ).groupby(by=data.index.month).mean()
-    mean_advance.clip(lower=0, upper=1, inplace=True)
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        advance = _pd.DataFrame(
+            data=values / values[last[codes]],
+            columns=columns
+            )
+
+    month = [data[column].values for column in by] + [
+        _pd.DatetimeIndex(data.index).month.values
+        ]
+    mean_advance = advance.groupby(by=month).mean().clip(lower=0, upper=1)
     exposure = mean_advance['SEMBRADO_HA'] - mean_advance['COSECHADO_HA']
-    return(exposure / exposure.sum())
+
+    if not by:
+        exposure.index.name = data.index.name
+        return(exposure / exposure.sum())
+
+    exposure.index.names = by + [None]
+    weight = exposure / exposure.groupby(level=by).transform('sum')
+    return(weight.unstack())
@@ -4,15 +4,168 @@ Created on Mon Sep 30 12:59:58 2019
 
 @author: r.realrangel
 """
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import functools
+import hashlib
+import inspect
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
+import xarray as xr
 from drought_t import data_manager as dmgr
 from scipy import stats
 from sklearn.model_selection import KFold
 # from sklearn.model_selection import train_test_split
 
+from .data_modelling import lowess_fit
 
+try:
+    import numba
+
+except ImportError:   # <- numba is optional.
+    numba = None
+
+
+class SmoothingCache():
+    """
+    Cache of smoothed series, keyed by a fingerprint of the input series
+    (values, index and name or columns) and the smoothing parameters.
+
+    The results are kept in an in-memory LRU and, if a directory is
+    given, also pickled there, so they are reused across sessions. It
+    is enabled with enable_smoothing_cache.
+    """
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+
+        if self.directory is not None:
+            Path(self.directory).mkdir(parents=True, exist_ok=True)
+
+    def fingerprint(self, x, **parameters):
+        digest = hashlib.sha1(
+            pd.util.hash_pandas_object(x, index=True).values.tobytes()
+            )
+        # The values do not hash the labels, which the results carry.
+        labels = x.name if isinstance(x, pd.Series) else list(x.columns)
+        digest.update(repr(labels).encode())
+        digest.update(repr(sorted(parameters.items())).encode())
+        return(digest.hexdigest())
+
+    def get(self, key):
+        if key in self._results:
+            self._results.move_to_end(key)
+            self.hits += 1
+            return(self._results[key].copy())
+
+        if self.directory is not None:
+            filename = Path(self.directory) / (key + '.pkl')
+
+            if filename.exists():
+                self.hits += 1
+                self._store(key, pd.read_pickle(filename))
+                return(self._results[key].copy())
+
+        self.misses += 1
+        return(None)
+
+    def put(self, key, value):
+        self._store(key, value.copy())
+
+        if self.directory is not None:
+            value.to_pickle(Path(self.directory) / (key + '.pkl'))
+
+    def _store(self, key, value):
+        self._results[key] = value
+        self._results.move_to_end(key)
+
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+
+    def stats(self):
+        return({
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._results)
+            })
+
+    def clear(self):
+        self._results.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Cache used by the smoothing functions (None if disabled).
+smoothing_cache = None
+
+
+def enable_smoothing_cache(maxsize=128, directory=None):
+    """
+    Enable the cache of the smoothing functions (lowess and maverage).
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of results kept in memory. By default, 128.
+    directory : str, optional
+        Directory where the results are also stored. By default, None
+        (only in memory).
+
+    Returns
+    -------
+    SmoothingCache
+        The cache, whose stats() method reports its hits and misses.
+    """
+    global smoothing_cache
+    smoothing_cache = SmoothingCache(maxsize=maxsize, directory=directory)
+    return(smoothing_cache)
+
+
+def disable_smoothing_cache():
+    """
+    Disable the cache of the smoothing functions.
+    """
+    global smoothing_cache
+    smoothing_cache = None
+
+
+def memoize_smoothing(function):
+    """
+    Look up the results of a smoothing function (whose first argument
+    is the series to smooth) in smoothing_cache, when it is enabled.
+    """
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if smoothing_cache is None:
+            return(function(*args, **kwargs))
+
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        parameters = dict(arguments.arguments)
+        series = parameters.pop(list(signature.parameters)[0])
+        key = smoothing_cache.fingerprint(
+            series,
+            function=function.__name__,
+            **parameters
+            )
+        result = smoothing_cache.get(key)
+
+        if result is None:
+            result = function(*args, **kwargs)
+            smoothing_cache.put(key, result)
+
+        return(result)
+
+    return(wrapper)
+
+
+@memoize_smoothing
 def lowess(data, poly=2):
     def optimal_f(exog, endog, it=2, xval_folds=3):
         """
@@ -33,25 +186,24 @@ def lowess(data, poly=2):
             step=(oneday * 1)
             )
 
+        # Split the sample in training and testing subsets, once for
+        # all the fractions.
+        folds = [
+            (exog[trn_fold], endog[trn_fold], exog[tst_fold], endog[tst_fold])
+            for trn_fold, tst_fold in kf.split(endog)
+            ]
+
         for i, f in enumerate(f_tries):
             mae = []
 
-            for trn_fold, tst_fold in kf.split(endog):
-                # Split the sample in training and testing subsets.
-                exog_tst = exog[tst_fold].copy()
-                endog_tst = endog[tst_fold].copy()
-                exog_trn = exog[trn_fold].copy()
-                endog_trn = endog[trn_fold].copy()
-
+            for exog_trn, endog_trn, exog_tst, endog_tst in folds:
                 # Apply the model.
-                data_model = sm.nonparametric.lowess(
-                    endog=endog_trn,
-                    exog=exog_trn,
+                endog_trn_model = lowess_fit(
+                    x=exog_trn,
+                    y=endog_trn,
                     frac=f,
-                    it=2,
-                    missing='raise'
+                    it=it
                     )
-                endog_trn_model = data_model[:, 1].copy()
 
                 # Test the results.
                 endog_tst_model = np.interp(
@@ -87,18 +239,17 @@ def lowess(data, poly=2):
         it=2,
         xval_folds=3
         )
-    data_model = sm.nonparametric.lowess(
-        endog=data_y,
-        exog=data_x,
+    data_lowess = data.copy()
+    data_lowess[data_lowess.notna()] = lowess_fit(
+        x=data_x,
+        y=data_y,
         frac=f,
-        it=2,
-        missing='raise'
+        it=2
         )
-    data_lowess = data.copy()
-    data_lowess[data_lowess.notna()] = data_model[:, 1]
     return(data_lowess)
 
 
+@memoize_smoothing
 def maverage(x, window, min_periods_r):
     """
     Smoothes the raw records of a variable.
@@ -137,9 +288,165 @@ def smoothvar(x, **parameters):
             poly=parameters['poly']))
 
 
+def doy_quantile(
+        x, q=0.5, window=29, max_zero=False, min_notnull=0.667,
+        min_wet_ratio=0.1, chunk=64
+        ):
+    """
+    Compute the quantile of the values within a window centered on
+    each day of the year.
+
+    The series is laid out once on a continuous daily calendar and the
+    windows of every day of the year and every year are taken as
+    strided views of it, so the filters and the quantiles of the 365
+    days are computed in a single pass. The windows follow the same
+    calendar rules as the ones used by normedian: they start at
+    ceil(window / 2) days before the day of the year, they cover
+    window + 1 days and February 29 values are considered missing.
+
+    Parameters
+    ----------
+    x : pandas.Series or pandas.DataFrame
+        The time series of the input data. If a DataFrame is given,
+        each column (e.g., each station) is processed as an independent
+        series sharing the same time index.
+    q : float, optional
+        The value of the percentile to compute. By default, 0.5.
+    window : int, optional
+        Size of the window centered on each day of the year. By
+        default, 29.
+    max_zero : float, optional
+        Maximum dry value. Every value below or equal is considered to
+        be zero. By default, False (zeros are not removed).
+    min_notnull : int, optional
+        Minumum fraction of values available within the applicable
+        window in a given year to be included in the analysis. By
+        default, 0.667.
+    min_wet_ratio : float, optional
+        Minimum ratio of wet values of the chosen values to perform
+        the computation of the percentile. By default, 0.1.
+    chunk : int, optional
+        Number of columns of x processed at once. It bounds the memory
+        used by the windows. By default, 64.
+
+    Returns
+    -------
+    pandas.Series or pandas.DataFrame
+        The quantile of each day of the year, indexed by month * 100 +
+        day (from 101 to 1231; February 29 is not included).
+    """
+    doys = pd.date_range(start='1981-01-01', end='1981-12-31')
+    window_first = doys - pd.Timedelta(value=window / 2, unit='D')
+    years = np.array(sorted(set(x.index.year - 1)))
+    starts = pd.DatetimeIndex(pd.to_datetime(pd.DataFrame({
+        'year': np.repeat(years, len(doys)),
+        'month': np.tile(window_first.month, len(years)),
+        'day': np.tile(window_first.day, len(years))
+        })))
+    length = int(np.floor(window)) + 1
+
+    # Lay out the series on a continuous daily calendar. Dates missing
+    # in x are kept apart from NaN values because only the latter are
+    # part of the samples.
+    calendar = pd.date_range(
+        start=min(starts.min(), x.index.min().normalize()),
+        end=max(starts.max(), x.index.max().normalize()) + pd.Timedelta(
+            value=length,
+            unit='D'
+            )
+        )
+    table = x.to_frame() if isinstance(x, pd.Series) else x
+    data = table.reindex(index=calendar).values.astype('float64')
+    data[(calendar.month == 2) & (calendar.day == 29)] = np.nan
+    present = calendar.isin(x.index).astype('float64')
+    year = calendar.year.values - calendar.year.min()
+
+    # Windows of every day of the year (axis 0) and year (axis 1),
+    # shared by all the columns.
+    pos = (
+        (starts - calendar[0]).days.values.reshape(len(years), len(doys)).T
+        )
+    present = np.lib.stride_tricks.sliding_window_view(present, length)[pos]
+    year = np.lib.stride_tricks.sliding_window_view(year, length)[pos]
+    key = (
+        np.arange(len(doys)).reshape(-1, 1, 1) * (year.max() + 1)
+        ) + year
+    n_keys = len(doys) * (year.max() + 1)
+    output = np.full((len(doys), data.shape[1]), np.nan)
+
+    for first in range(0, data.shape[1], chunk):
+        # Windows of the columns in the chunk (axis 0).
+        values = np.moveaxis(
+            np.lib.stride_tricks.sliding_window_view(
+                data[:, first:first + chunk],
+                window_shape=length,
+                axis=0
+                )[pos],
+            source=2,
+            destination=0
+            )
+        notnull = ~np.isnan(values)
+
+        # Remove the years (of the dates, not of the windows) with
+        # fewer than min_notnull values.
+        col_key = (
+            np.arange(len(values)).reshape(-1, 1, 1, 1) * n_keys
+            ) + key
+        count = np.bincount(
+            col_key.ravel(),
+            weights=notnull.ravel(),
+            minlength=(len(values) * n_keys)
+            )[col_key]
+        keep = count > (min_notnull * window)
+        subset = np.where(keep, present, 0).sum(axis=(2, 3))
+
+        # Remove zero-values.
+        if max_zero is False:
+            wet = keep & notnull
+            wet_len = subset
+
+        else:
+            with np.errstate(invalid='ignore'):
+                wet = keep & (values > max_zero)
+
+            wet_len = wet.sum(axis=(2, 3))
+
+        # Compute the quantile only if, at least, min_wet_ratio of the
+        # chosen values are nonzero.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            valid = ((wet_len / subset) > min_wet_ratio).T
+
+        samples = np.moveaxis(
+            np.where(wet, values, np.nan),
+            source=0,
+            destination=1
+            ).reshape(len(doys), len(values), -1)[valid]
+        output_chunk = output[:, first:first + chunk]
+
+        if len(samples) > 0:
+            output_chunk[valid] = np.nanpercentile(
+                samples,
+                q=(q * 100),
+                axis=1
+                )
+
+    output = pd.DataFrame(
+        data=output,
+        index=((doys.month * 100) + doys.day),
+        columns=table.columns
+        )
+
+    if isinstance(x, pd.Series):
+        return(output.iloc[:, 0].rename(x.name))
+
+    else:
+        return(output)
+
+
 def normedian(
         x, q=0.5, window=29, max_zero=False, min_notnull=0.667,
-        min_wet_ratio=0.1, min_len=15, smooth=False, smoothpar=None
+        min_wet_ratio=0.1, min_len=15, smooth=False, smoothpar=None,
+        chunk=64
         ):
     """
     Compute 50th percentile of long-term daily records of a variable.
@@ -151,8 +458,11 @@ def normedian(
 
     Parameters
     ----------
-    x : pandas.Series
-        The time series of the input data.
+    x : pandas.Series, pandas.DataFrame or xarray.DataArray
+        The time series of the input data. Many stations can be
+        processed in one call by passing a DataFrame (one column per
+        station) or a DataArray with a 'time' dimension (e.g., time x
+        station or time x lat x lon).
     q : float, optional
         The value of the percentile to usa as threshold level. By
         default, 0.5.
@@ -170,114 +480,214 @@ def normedian(
     min_wet_ratio : float, optional
         Minimum ratio of wet values of the chosen values to perform
         the computation of the percentile.
+    chunk : int, optional
+        Number of stations processed at once when x contains many
+        stations. By default, 64.
 
     Returns
     -------
-    pandas.Series
-        The time series of the base value (x0) with the same length as
+    pandas.Series, pandas.DataFrame or xarray.DataArray
+        The time series of the base value (x0) with the same shape as
         the input x.
     """
-    # Prepare the output pandas.Series.
-    x0 = x.copy() * np.nan
+    if isinstance(x, xr.DataArray) and x.ndim == 1:
+        # A single time series (nothing to stack).
+        x0 = normedian(
+            x=x.to_series(),
+            q=q,
+            window=window,
+            max_zero=max_zero,
+            min_notnull=min_notnull,
+            min_wet_ratio=min_wet_ratio,
+            min_len=min_len,
+            smooth=smooth,
+            smoothpar=smoothpar,
+            chunk=chunk
+            )
+        return(x.copy(data=x0.values))
 
-    for date in pd.date_range(start='1981-01-01', end='1981-12-31'):
-        data_window = pd.Series()
+    elif isinstance(x, xr.DataArray):
+        # Process every grid cell or station as a column of a table.
+        x_stacked = x.stack(
+            point=[dim for dim in x.dims if dim != 'time']
+            ).transpose('time', 'point')
+        x0 = normedian(
+            x=pd.DataFrame(
+                data=x_stacked.values,
+                index=x_stacked.time.to_index()
+                ),
+            q=q,
+            window=window,
+            max_zero=max_zero,
+            min_notnull=min_notnull,
+            min_wet_ratio=min_wet_ratio,
+            min_len=min_len,
+            smooth=smooth,
+            smoothpar=smoothpar,
+            chunk=chunk
+            )
+        return(x_stacked.copy(data=x0.values).unstack('point'))
 
-        # Extract the values in the corresponding date window.
-        for year in list(set(x.index.year - 1)):
-            window_first = date - pd.Timedelta(
-                value=window / 2,
-                unit='D'
-                )
-            window_first = pd.datetime(
-                year=year,
-                month=window_first.month,
-                day=window_first.day
-                )
-            window_last = window_first + pd.Timedelta(
-                value=window,
-                unit='D'
-                )
-            data_window = data_window.append(
-                to_append=x[
-                    (x.index >= window_first) &
-                    (x.index <= window_last)
-                    ]
+    def complete(x0):
+        # Set February 29 values as the mean of their corresponding
+        # February 28 and March 1.
+        x0[(x0.index.month == 2) & (x0.index.day == 29)] = np.mean([
+            x0['1981-02-28'], x0['1981-03-01']
+            ])
+
+        # Fill short periods of missing with linear interpolation.
+        x0.interpolate(
+            method='linear',
+            limit=3,
+            inplace=True,
+            limit_direction='both',
+            limit_area='inside'
+            )
+
+        # Smooth the resulting x0.
+        if smooth:
+            x0 = smoothvar(
+                x=x0,
+                **smoothpar
                 )
+#        if smoothing_method == 'lowess':
+#            poly = smoothpar['poly']
+#            x0 = lowess(
+#                data=x0,
+#                poly=poly
+#                )
+#
+#        elif smoothing_method == 'ma':
+#            smoothing_window = smoothpar['smoothing_window']
+#            smoothing_min_periods_r = smoothpar['smoothing_min_periods_r']
+#            x0 = maverage(
+#                x=x0,
+#                window=smoothing_window,
+#                min_periods_r=smoothing_min_periods_r
+#                )
 
-        # Remove February 29 values.
-        data_window[
-            (data_window.index.month == 2) &
-            (data_window.index.day == 29)
-            ] = np.nan
+        # Remove stretches shorter than min_len.
+        def remove_shorts(group):
+            # ??? <- Just "len(group) < min_len"?
+            if 1 < len(group) < min_len:
+                return(group * np.nan)
 
-        # Remove years with fewer than min_notnull values.
-        data_subset = data_window.groupby(
-            by=data_window.index.year
-            ).filter(lambda group: group.count() > (min_notnull * window))
+            else:
+                return(group)
 
-        # Remove zero-values.
-        if max_zero is False:
-            data_subset_wet = data_subset.copy()
+        x0 = x0.groupby(by=x0.isna().cumsum()).transform(remove_shorts)
+        return(x0)
 
-        else:
-            data_subset_wet = data_subset[data_subset > max_zero]
-
-        # Compute the x0 only if, at least, min_wet_ratio of the chosen
-        # values are nonzero.
-        if len(data_subset_wet) / float(len(data_subset)) > min_wet_ratio:
-            x0[
-                (x0.index.month == date.month) &
-                (x0.index.day == date.day)
-                ] = data_subset_wet.quantile(q=q)
-
-    # Set February 29 values as the mean of their corresponding
-    # February 28 and March 1.
-    x0[(x0.index.month == 2) & (x0.index.day == 29)] = np.mean([
-        x0['1981-02-28'], x0['1981-03-01']
-        ])
-
-    # Fill short periods of missing with linear interpolation.
-    x0.interpolate(
-        method='linear',
-        limit=3,
-        inplace=True,
-        limit_direction='both',
-        limit_area='inside'
+    # Prepare the output pandas.Series (or pandas.DataFrame).
+    x0 = x.copy() * np.nan
+    x0_doy = doy_quantile(
+        x=x,
+        q=q,
+        window=window,
+        max_zero=max_zero,
+        min_notnull=min_notnull,
+        min_wet_ratio=min_wet_ratio,
+        chunk=chunk
         )
+    x0[:] = x0_doy.reindex(
+        index=((x0.index.month * 100) + x0.index.day)
+        ).values
 
-    # Smooth the resulting x0.
-    if smooth:
-        x0 = smoothvar(
-            x=x0,
-            **smoothpar
-            )
-#    if smoothing_method == 'lowess':
-#        poly = smoothpar['poly']
-#        x0 = lowess(
-#            data=x0,
-#            poly=poly
-#            )
-#
-#    elif smoothing_method == 'ma':
-#        smoothing_window = smoothpar['smoothing_window']
-#        smoothing_min_periods_r = smoothpar['smoothing_min_periods_r']
-#        x0 = maverage(
-#            x=x0,
-#            window=smoothing_window,
-#            min_periods_r=smoothing_min_periods_r
-#            )
+    if isinstance(x0, pd.DataFrame):
+        return(x0.apply(complete))
+
+    else:
+        return(complete(x0))
+
+
+def lynehollick_kernel(q, qf, qb, a, passes):
+    """
+    Recursive digital filter of Lyne and Hollick.
 
-    # Remove stretches shorter than min_len.
-    def remove_shorts(group):
-        if 1 < len(group) < min_len:  # ??? <- Just "len(group) < min_len"?
-            return(group * np.nan)
+    It is written with plain loops over scalars so that it can be
+    compiled with numba when it is available. The quickflow (qf) and
+    baseflow (qb) sequences are filled in place.
+
+    Parameters
+    ----------
+    q : sequence of float
+        Streamflow, including the warm up and cool down periods.
+    qf, qb : sequence of float
+        Outputs of the quickflow and the baseflow, with the same length
+        as q.
+    a : float
+        Filter parameter.
+    passes : int
+        Number of passes of the filter. Odd passes run forward and even
+        passes run backward.
+    """
+    qin = q
+
+    for _pass in range(passes):
+        if _pass > 0:
+            qin = qb.copy()
+
+        if (_pass + 1) % 2 == 1:
+            first, last, step = 0, len(q), 1
 
         else:
-            return(group)
+            first, last, step = len(q) - 1, -1, -1
+
+        for i in range(first, last, step):
+            if i == first:
+                qf[i] = qin[i]
+
+            else:
+                qf[i] = (   # <- Filter
+                    (a * qf[i - step]) +
+                    (((1 + a) / 2) * (qin[i] - qin[i - step]))
+                    )
+
+            if qf[i] <= 0:
+                qf[i] = 0
+
+            qb[i] = qin[i] - qf[i]
+
 
-    x0 = x0.groupby(by=x0.isna().cumsum()).transform(remove_shorts)
-    return(x0)
+if numba is not None:
+    lynehollick_kernel_compiled = numba.njit(cache=True)(lynehollick_kernel)
+
+
+def lynehollick_filter(q, a=0.925, passes=3):
+    """
+    Apply the Lyne and Hollick filter to a sequence of streamflow.
+
+    Uses the numba-compiled kernel when numba is installed and the
+    pure-Python kernel (over Python floats) otherwise. Both give the
+    same baseflow.
+
+    Parameters
+    ----------
+    q : numpy.ndarray
+        Streamflow, including the warm up and cool down periods.
+    a : float, optional
+        Filter parameter. By default, 0.925.
+    passes : int, optional
+        Number of passes of the filter. By default, 3.
+
+    Returns
+    -------
+    numpy.ndarray
+        Baseflow.
+    """
+    q = np.array(q, dtype='float64')
+
+    if numba is not None:
+        qf = np.full(len(q), np.nan)
+        qb = np.full(len(q), np.nan)
+        lynehollick_kernel_compiled(q, qf, qb, float(a), int(passes))
+        return(qb)
+
+    else:
+        qf = [np.nan] * len(q)
+        qb = [np.nan] * len(q)
+        lynehollick_kernel(q.tolist(), qf, qb, float(a), int(passes))
+        return(np.array(qb, dtype='float64'))
 
 
 def lynehollick(x, a=0.925, reflection=30, passes=3):
@@ -290,7 +700,7 @@ def lynehollick(x, a=0.925, reflection=30, passes=3):
 
     """
     if len(x) < 65:
-        return(x * pd.np.nan)
+        return(x * np.nan)
 
     else:
         x_notna = x[x.notna()]
@@ -309,38 +719,240 @@ def lynehollick(x, a=0.925, reflection=30, passes=3):
                 )
             )
         q = pd.concat(objs=[x_warm, x_notna, x_cool])
-        qf = q.copy() * pd.np.nan
-        qb = q.copy() * pd.np.nan
+        qb = pd.Series(
+            data=lynehollick_filter(q=q.values, a=a, passes=passes),
+            index=q.index
+            )
+        return(qb.reindex(index=x.index))
 
-        for _pass in range(passes):
-            if _pass == 0:
-                qin = q.copy()
 
-            else:
-                qin = qb.copy()
+def lynehollick_gauges(gauges, a, reflection, passes):
+    """
+    Apply lynehollick to a block of gauges. Errors of a gauge are
+    reported instead of raised, so that the rest of the block is not
+    lost.
 
-            if (_pass + 1) % 2 == 1:
-                it = range(len(q))
+    Parameters
+    ----------
+    gauges : list
+        Pairs of (gauge name, streamflow), where the streamflow is a
+        pandas.Series or the path of a CSV file.
+    a, reflection, passes
+        Parameters of lynehollick.
 
-            else:
-                it = range(len(q) - 1, -1, -1)
+    Returns
+    -------
+    list
+        Tuples of (gauge name, baseflow, error).
+    """
+    output = []
 
-            for i in range(len(it)):
-                if i == 0:
-                    qf[it[i]] = qin[it[i]]
+    for name, x in gauges:
+        try:
+            if not isinstance(x, pd.Series):
+                x = pd.read_csv(
+                    filepath_or_buffer=x,
+                    index_col=0,
+                    parse_dates=True
+                    ).iloc[:, 0]
 
-                else:
-                    qf[it[i]] = (   # <- Filter
-                        (a * qf[it[i - 1]]) +
-                        (((1 + a) / 2) * (qin[it[i]] - qin[it[i - 1]]))
-                        )
+            # Too few data to apply the filter.
+            if x.notna().sum() < 65:
+                output.append((name, x * np.nan, None))
+                continue
 
-                if qf[it[i]] <= 0:
-                    qf[it[i]] = 0
+            output.append((name, lynehollick(
+                x=x,
+                a=a,
+                reflection=reflection,
+                passes=passes
+                ).rename(x.name), None))
 
-                qb[it[i]] = qin[it[i]] - qf[it[i]]
+        except Exception as err:
+            output.append((
+                name,
+                None,
+                '{}: {}'.format(type(err).__name__, err)
+                ))
 
-        return(qb.reindex(index=x.index))
+    return(output)
+
+
+def lynehollick_batch(
+        data, a=0.925, reflection=30, passes=3, workers=None, chunksize=16
+        ):
+    """
+    Baseflow separation of many gauges with a pool of processes.
+
+    Results are yielded as soon as their block of gauges is finished,
+    so they do not come in the same order as the gauges. A gauge with
+    fewer than 65 valid values gets a baseflow full of NaN and a gauge
+    that raises an error gets None and the error message; neither of
+    them stops the rest of the run.
+
+    Example:
+        baseflow = pd.DataFrame({
+            gauge: qb
+            for gauge, qb, error in lynehollick_batch(data=flows)
+            if error is None
+            })
+
+    Parameters
+    ----------
+    data : pandas.DataFrame or str
+        Streamflow of the gauges (one column per gauge) or the path of
+        a directory with a CSV file per gauge (dates in the first
+        column and streamflow in the second one; the gauge is named
+        after the file).
+    a : float, optional
+        Filter parameter. By default, 0.925.
+    reflection : int, optional
+        Length of the warm up and cool down periods. By default, 30.
+    passes : int, optional
+        Number of passes of the filter. By default, 3.
+    workers : int, optional
+        Number of worker processes. By default (None), the number of
+        processors of the machine. If 1, the gauges are processed in
+        the current process.
+    chunksize : int, optional
+        Number of gauges sent to a worker at once. By default, 16.
+
+    Yields
+    ------
+    tuple
+        (gauge name, baseflow as pandas.Series, error message or None).
+    """
+    if isinstance(data, pd.DataFrame):
+        gauges = [(name, data[name]) for name in data.columns]
+
+    else:
+        gauges = [
+            (filename.stem, str(filename))
+            for filename in sorted(Path(data).glob('*.csv'))
+            ]
+
+    blocks = [
+        gauges[first:first + chunksize]
+        for first in range(0, len(gauges), chunksize)
+        ]
+
+    if workers == 1:
+        for block in blocks:
+            for result in lynehollick_gauges(
+                    gauges=block,
+                    a=a,
+                    reflection=reflection,
+                    passes=passes
+                    ):
+                yield(result)
+
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    lynehollick_gauges,
+                    gauges=block,
+                    a=a,
+                    reflection=reflection,
+                    passes=passes
+                    )
+                for block in blocks
+                ]
+
+            for future in as_completed(futures):
+                for result in future.result():
+                    yield(result)
+
+
+def dominance_rank(data, block=1024):
+    """
+    Count, for each point, the points that it dominates, i.e., the
+    points whose values are less than or equal to its own in every
+    dimension (the point itself included).
+
+    Points with missing values dominate, and are dominated by, no
+    point, so their rank is 0. In one dimension the ranks come from a
+    sort, in two dimensions from a sweep over the first dimension with a
+    Fenwick (binary indexed) tree over the second one, both in
+    O(n log n). In more dimensions the points are compared in blocks of
+    rows.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The points. It contains as many rows as points and as many
+        columns as dimensions.
+    block : int, optional
+        Number of rows compared at once when there are more than two
+        dimensions. By default, 1024.
+
+    Returns
+    -------
+    numpy.ndarray
+        The rank of each point.
+    """
+    data = np.asarray(data, dtype='float64')
+
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+
+    rank = np.zeros(len(data), dtype='int64')
+    valid = np.all(~np.isnan(data), axis=1)
+    points = data[valid]
+
+    if data.shape[1] == 1:
+        rank[valid] = np.searchsorted(
+            np.sort(points[:, 0]),
+            points[:, 0],
+            side='right'
+            )
+
+    elif data.shape[1] == 2:
+        # Sweep the points by x; every point with the same x is added to
+        # the tree before any of them is queried, so ties dominate each
+        # other.
+        order = np.argsort(points[:, 0], kind='mergesort')
+        x_sorted = points[order, 0]
+        group_end = np.searchsorted(x_sorted, x_sorted, side='right')
+        y_unique = np.unique(points[:, 1])
+        y_pos = (
+            np.searchsorted(y_unique, points[order, 1], side='left') + 1
+            ).tolist()
+        tree = [0] * (len(y_unique) + 1)
+        count = [0] * len(points)
+        added = 0
+
+        for k in range(len(points)):
+            while added < group_end[k]:
+                j = y_pos[added]
+
+                while j <= len(y_unique):
+                    tree[j] += 1
+                    j += j & (-j)
+
+                added += 1
+
+            j = y_pos[k]
+
+            while j > 0:
+                count[k] += tree[j]
+                j -= j & (-j)
+
+        points_rank = np.zeros(len(points), dtype='int64')
+        points_rank[order] = count
+        rank[valid] = points_rank
+
+    else:
+        rank[valid] = np.concatenate([
+            np.all(
+                points[np.newaxis, :, :] <=
+                points[first:first + block, np.newaxis, :],
+                axis=2
+                ).sum(axis=1)
+            for first in range(0, len(points), block)
+            ] + [np.zeros(0, dtype='int64')])
+
+    return(rank)
 
 
 def rank2v(x, y):
@@ -351,11 +963,7 @@ def rank2v(x, y):
             frequency analysis. Journal of Hydrology, 226(1–2), 88–100
             https://doi.org/10.1016/S0022-1694(99)00168-7.
     """
-    xy = np.array([x.values, y.values]).T
-    rank = np.array([
-        len(np.where(np.all(xy[:] <= xy[i], axis=1))[0])
-        for i in range(len(xy))
-        ])
+    rank = dominance_rank(data=np.array([x.values, y.values]).T)
     return(pd.Series(
         data=rank,
         index=x.index,
@@ -363,7 +971,7 @@ def rank2v(x, y):
         ))
 
 
-def empirical_probability(X, a=0.44):
+def empirical_probability(X, a=0.44, max_memory=2**28):
     """Computes the empirical probability.
 
      Empirical probability is computed using the plotting position
@@ -403,6 +1011,10 @@ def empirical_probability(X, a=0.44):
         columns as variables.
     a : float
         Parameter a in the general formula for plotting possitions.
+    max_memory : int, optional
+        Approximate maximum size (in bytes) of the temporary arrays.
+        The grid is processed in tiles of cells small enough to stay
+        below it. By default, 2**28 (256 MB).
 
     Returns
     -------
@@ -410,10 +1022,55 @@ def empirical_probability(X, a=0.44):
         Sequence of values representing the empirical probability
         of each element of the time series.
     """
+    def count_le(values):
+        # Number of values of each cell (axis 1) lower than or equal to
+        # each value, taken from the position of the last of its ties
+        # in the sorted series.
+        order = np.argsort(values, axis=0, kind='mergesort')
+        ranked = np.take_along_axis(values, order, axis=0)
+        last = np.ones(np.shape(ranked), dtype=bool)
+        last[:-1] = ranked[:-1] != ranked[1:]
+        tie_end = np.where(
+            last,
+            np.arange(len(ranked)).reshape(-1, 1),
+            len(ranked)
+            )
+        tie_end = np.minimum.accumulate(tie_end[::-1], axis=0)[::-1]
+        count = np.where(np.isnan(ranked), 0, tie_end + 1)
+        output = np.empty(np.shape(count), dtype='int64')
+        np.put_along_axis(output, order, count, axis=0)
+        return(output)
+
     n = np.all(np.isfinite(X), axis=3).sum(axis=(0))
-    i = np.ndarray((np.shape(X)[:-1])) * np.nan
+    i = np.ndarray((np.shape(X)[:-1]))
+    X_cells = np.reshape(X, (len(X), -1, np.shape(X)[-1]))
+    i_cells = np.reshape(i, (len(X), -1))
+
+    if np.shape(X)[-1] == 1:
+        cell_memory = len(X) * 8 * 6
+
+    else:
+        cell_memory = 2 * (len(X) ** 2)
+
+    tile = max(1, int(max_memory // max(cell_memory, 1)))
+
+    for first in range(0, np.shape(X_cells)[1], tile):
+        block = X_cells[:, first:first + tile]
+
+        if np.shape(X)[-1] == 1:
+            i_cells[:, first:first + tile] = count_le(values=block[:, :, 0])
+
+        else:
+            # Dominance count: [m, t] is True when X[t] <= X[m] in every
+            # variable (compared one variable at a time, which is much
+            # faster than np.all over a short last axis).
+            dominated = np.ones((len(X), ) + np.shape(block)[:2], dtype=bool)
+
+            for v in range(np.shape(X)[-1]):
+                dominated &= (
+                    block[np.newaxis, :, :, v] <= block[:, np.newaxis, :, v]
+                    )
 
-    for m, mat in enumerate(X):
-        i[m] = np.all(X <= mat, axis=3).sum(axis=0)
+            i_cells[:, first:first + tile] = dominated.sum(axis=1)
 
     return((i - a) / (n + 1 - (2 * a)))